@@ -1,92 +1,796 @@
 #! /usr/bin/env python3
 
 import os
+import re
+import sys
+import json
 import glob
+import gzip
+import math
+import hashlib
+import tarfile
 import argparse
+import subprocess
+import contextlib
+import concurrent.futures
 
 
 parser = argparse.ArgumentParser(description='merge_mg_pythia_delphes_output.py')
 
-parser.add_argument('-i', '--inputs', nargs='+', required=True, help='Configuration file')
+inputs = parser.add_mutually_exclusive_group(required=True)
+inputs.add_argument('-i', '--inputs', nargs='+', help='Input files (glob patterns are expanded)')
+inputs.add_argument('-d', '--input-dir', help='Condor output directory: the job outputs are grouped by run name and merged in <output>/merged_<run_name>')
 parser.add_argument('-o', '--output', required=True, help='Output directory')
+parser.add_argument('-r', '--run-name', default=None, help='Only merge the job outputs of this run name (output_<run_name>_<cluster>_<proc>.tar.gz, or shower_ for the shower jobs)')
 
 parser.add_argument('-e', '--extract-lhe', action='store_true', help='Extract lhe.gz files')
 parser.add_argument('-k', '--keep-all', action='store_true', help='Keep extracted job files')
+parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of parallel workers to read the input files and merge the root files')
+parser.add_argument('--fan-in', type=int, default=32, help='Number of root files merged by each hadd call')
+parser.add_argument('--max-merges', type=int, default=None, help='Number of run names merged at the same time with -d')
+parser.add_argument('--keep-duplicates', action='store_true', help='Merge the inputs with the same events as another input (they are only reported)')
+parser.add_argument('--fingerprint-events', type=int, default=10, help='Number of events used to find duplicate inputs')
+parser.add_argument('-u', '--incremental', action='store_true', help='Merge only the inputs not merged before into the existing merged files of the output directory')
 
 args = parser.parse_args()
 
 output_file = args.output
-input_files = args.inputs
+
+# exit code of a merge that skipped inputs: the merged files and the manifest are written, but the
+# merge is an error (a -d group with it is reported as PARTIAL instead of FAILED)
+partial_exit_code = 3
+
+# expand patterns here too, in case they were not expanded by the shell (e.g. DAG nodes)
+input_files = []
+for pattern in args.inputs or []:
+    if any(c in pattern for c in '*?['):
+        input_files.extend(sorted(glob.glob(pattern)))
+    else:
+        input_files.append(pattern)
+
+# job outputs are output_<run_name>_<cluster>_<proc>.tar.gz (shower_ for the shower jobs): with -r only the ones
+# with exactly this run name are kept (a pattern like output_A_*.tar.gz also matches the outputs of a run A_B)
+re_job_output = re.compile(r'(?:output|shower)_(.+)_(\d+)_(\d+)\.tar\.gz')
+
+def get_run_name(file):
+    match = re_job_output.fullmatch(os.path.basename(file))
+    return match.group(1) if match else None
+
+if args.run_name is not None:
+    input_files = [ file for file in input_files if get_run_name(file) == args.run_name ]
 
 if output_file.endswith('.tar.gz'):
     tmpdir = 'tmp_output'
 else:
     tmpdir = output_file
 
+if args.input_dir and output_file.endswith('.tar.gz'):
+    parser.error('-d/--input-dir needs an output directory')
+
+if args.incremental and (output_file.endswith('.tar.gz') or args.extract_lhe):
+    parser.error('--incremental needs an output directory and can\'t be used with --extract-lhe')
+
 
 print("Running merge_mg_pythia_delphes_output with:")
 print(f'output_file = {output_file}')
-print(f'input_files = {input_files}')
+if args.input_dir:
+    print(f'input_dir = {args.input_dir}')
+else:
+    print(f'input_files = {input_files}')
+
+# Incremental merge
+# the manifest lists the inputs already merged in the output directory (identified by path, size
+# and modification time). Only the new inputs are read, and the existing merged files are merged
+# with them as the first input
+manifest_file = f'{tmpdir}/merge_manifest.json'
+
+def input_id(file):
+    st = os.stat(file)
+    return { 'size': st.st_size, 'mtime': st.st_mtime }
+
+def already_merged(file):
+    entry = manifest['inputs'].get(os.path.abspath(file), {})
+    return all(entry.get(k) == v for k, v in input_id(file).items())
+
+manifest = { 'inputs': {} }
+if args.incremental and not args.input_dir and os.path.exists(manifest_file):
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    new_files = [ file for file in input_files if not already_merged(file) ]
+    print(f'{len(input_files) - len(new_files)} inputs already merged, {len(new_files)} new')
+    input_files = new_files
+
+    if not input_files:
+        print('Nothing to merge')
+        raise SystemExit(0)
+
+# LHE streaming merge, without the container: the header and <init> of each file are read
+# while scanning the inputs, then the events of all the files are copied in a second pass
+re_lhe_nevents = re.compile(rb'(#\s*Number of Events\s*:\s*)(\d+)')
+re_lhe_xsec = re.compile(rb'(#\s*Integrated weight \(pb\)\s*:\s*)(\S+)')
+
+def read_lhe_header(f):
+    # header (up to <init>), init lines and number of events (from the MG banner or counted)
+    header = b''
+    for line in f:
+        if line.strip() == b'<init>':
+            break
+        header += line
+
+    init = []
+    for line in f:
+        if line.strip() == b'</init>':
+            break
+        init.append(line)
+
+    match = re_lhe_nevents.search(header)
+    if match:
+        nevents = int(match.group(2))
+    else:
+        nevents = 0
+        for block in iter(lambda: f.read(1 << 20), b''):
+            nevents += block.count(b'<event>') + block.count(b'<event ')
+
+    return header, init, nevents
+
+def open_input(item):
+    # file written in tmpdir/all or member of a job tarball
+    if 'path' in item:
+        return open(item['path'], 'rb')
+    return open_member(item['file'], item['member'])
+
+def gunzip_if(f, name):
+    # lhco files are compressed in the job outputs (.lhco.gz)
+    return gzip.GzipFile(fileobj=f) if name.endswith('.gz') else f
+
+def merge_lhe_init(lhes):
+    """
+    <init> of the merged file: the beam line and other lines of the first file, and for each
+    process the cross section and error weighted by the number of events of each file
+    """
+    processes = {}
+    for lhe in lhes:
+        nprup = int(lhe['init'][0].split()[9])
+        for line in lhe['init'][1:1+nprup]:
+            xsec, xerr, xmax, lprup = line.split()[:4]
+            p = processes.setdefault(lprup, { 'n': 0, 'xsec': 0., 'xerr2': 0., 'xmax': 0. })
+            p['n'] += lhe['nevents']
+            p['xsec'] += float(xsec) * lhe['nevents']
+            p['xerr2'] += (float(xerr) * lhe['nevents'])**2
+            p['xmax'] = max(p['xmax'], float(xmax))
+
+    first = lhes[0]['init']
+    nprup = int(first[0].split()[9])
+
+    beam = first[0].split()
+    beam[9] = str(len(processes)).encode()
+
+    init = [ b' '.join(beam) + b'\n' ]
+    total_xsec = 0.
+    for lprup, p in processes.items():
+        n = max(p['n'], 1)
+        xsec = p['xsec'] / n
+        total_xsec += xsec
+        init.append(f'{xsec:.6e} {math.sqrt(p["xerr2"]) / n:.6e} {p["xmax"]:.6e} {lprup.decode()}\n'.encode())
+    init += first[1+nprup:]
+
+    return init, total_xsec
+
+re_lhe_wgt = re.compile(rb'(<wgt[^>]*>\s*)(\S+)')
+
+def copy_lhe_events(f, out, weight):
+    """
+    Copy the rest of the file, without the closing tag, setting the weight of each event (XWGTUP,
+    the third value of its first line) to weight, as merge.pl does, so the sum of the weights of
+    the merged file is its cross section. The <wgt> weights of the event are scaled in the same way
+    """
+    lines = []
+    first_line = False
+    scale = 1.
+    for line in f:
+        if first_line:
+            values = line.split()
+            scale = weight / abs(float(values[2])) if float(values[2]) else 0.
+            values[2] = b'%.10e' % math.copysign(weight, float(values[2]))
+            line = b' ' + b' '.join(values) + b'\n'
+            first_line = False
+        elif line.lstrip().startswith(b'<event'):
+            first_line = True
+        elif line.lstrip().startswith(b'<wgt'):
+            line = re_lhe_wgt.sub(lambda m: m.group(1) + b'%.10e' % (float(m.group(2)) * scale), line, count=1)
+        elif b'</LesHouchesEvents>' in line:
+            lines.append(line[:line.find(b'</LesHouchesEvents>')])
+            break
+        lines.append(line)
+        if len(lines) >= 4096:
+            out.writelines(lines)
+            lines = []
+    out.writelines(lines)
+
+def init_xsec(init):
+    # total cross section of an <init> block
+    nprup = int(init[0].split()[9])
+    return sum(float(line.split()[0]) for line in init[1:1+nprup])
+
+def check_lhe_init(init):
+    # the <init> block must have the beam line (NPRUP is its 10th value) and a line for each process
+    try:
+        nprup = int(init[0].split()[9])
+        valid = len(init) > nprup and all(len(line.split()) >= 4 for line in init[1:1+nprup])
+        if valid:
+            init_xsec(init)
+    except (IndexError, ValueError):
+        valid = False
+    if not valid:
+        raise ValueError('empty or malformed <init> block in the lhe file')
+
+def merge_lhe(lhes, output):
+    """
+    The header, the events of each input and the closing tag are written as separate gzip
+    members (read as a single stream by gzip readers), so the events of an input can be read
+    seeking to its member in the merged file. Returns the number of events, the cross section
+    and the slice of each input: first event, number of events, and offset and length of its
+    member (and of its events in the uncompressed file)
+    """
+    nevents = sum(lhe['nevents'] for lhe in lhes)
+    init, xsec = merge_lhe_init(lhes)
+    weight = xsec / max(nevents, 1)
+
+    with open_input(lhes[0]) as raw, gzip.GzipFile(fileobj=raw) as f:
+        header, _, _ = read_lhe_header(f)
+    header = re_lhe_nevents.sub(lambda m: m.group(1) + str(nevents).encode(), header, count=1)
+    header = re_lhe_xsec.sub(lambda m: m.group(1) + f'{xsec:.6e}'.encode(), header, count=1)
+
+    slices = []
+    with open(output, 'wb') as out:
+        data_offset = 0
+
+        def write_member(write):
+            nonlocal data_offset
+            offset = out.tell()
+            with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0) as member:
+                write(member)
+                data_length = member.tell()
+            data_offset += data_length
+            return { 'offset': offset, 'length': out.tell() - offset, 'data_offset': data_offset - data_length, 'data_length': data_length }
+
+        write_member(lambda member: member.write(header + b'<init>\n' + b''.join(init) + b'</init>\n'))
+
+        first_event = 0
+        for lhe in lhes:
+            if 'slices' in lhe:
+                # previous merged file (incremental merge): the members of its inputs are kept, with their
+                # events weights updated to the new cross section. Each member is decompressed streaming
+                with open(lhe['path'], 'rb') as f:
+                    for s in lhe['slices']:
+                        f.seek(s['offset'])
+                        def write_slice(member):
+                            with gzip.GzipFile(fileobj=LimitedReader(f, s['length'])) as events:
+                                copy_lhe_events(events, member, weight)
+                        slices.append(dict(s, **write_member(write_slice)))
+            else:
+                def write_events(member):
+                    with open_input(lhe) as raw, gzip.GzipFile(fileobj=raw) as f:
+                        for line in f:
+                            if line.strip() == b'</init>':
+                                break
+                        copy_lhe_events(f, member, weight)
+
+                s = { 'input': lhe.get('input'), 'member': lhe.get('member', os.path.basename(lhe.get('path', ''))),
+                      'first_event': first_event, 'nevents': lhe['nevents'], 'xsec': init_xsec(lhe['init']) }
+                slices.append(dict(s, **write_member(write_events)))
+            first_event += lhe['nevents']
+
+        write_member(lambda member: member.write(b'</LesHouchesEvents>\n'))
+
+    return nevents, xsec, slices
+
+# LHCO streaming merge: the event blocks of all the files are concatenated, renumbering the
+# events, after the banner (comments before the first event) of the first file
+re_lhco_event = re.compile(rb'(\n[ \t]*0)[ \t]+(\d+)(?=[ \t]+\d+[ \t]*(?:\n|\Z))')
+
+def merge_lhco(lhcos, output):
+    # returns the number of events and the slice of each input: first event, number of events,
+    # and offset and length of its events in the merged file
+    nevents = 0
+    first_number = None
+    slices = []
+
+    with open(output, 'wb') as out:
+        for i, lhco in enumerate(lhcos):
+            banner = True
+            first_write = True
+            start = None
+            first_event = nevents
+
+            def write(chunk):
+                nonlocal nevents, first_number, banner, first_write, start
+
+                # [text, '\n   0', number, text, ...]
+                parts = re_lhco_event.split(chunk)
+                if banner:
+                    if len(parts) == 1:
+                        if i > 0:
+                            return
+                    else:
+                        banner = False
+                        if i > 0:
+                            parts[0] = b''
+
+                numbers = parts[2::3]
+                if numbers:
+                    if first_number is None:
+                        first_number = int(numbers[0])
+                    parts[2::3] = [ b' %13d' % n for n in range(first_number + nevents, first_number + nevents + len(numbers)) ]
+                    nevents += len(numbers)
+
+                # the first newline of each file was added to find an event in the first line
+                if first_write:
+                    k = 0 if parts[0] else 1
+                    parts[k] = parts[k][1:]
+                    first_write = False
+
+                if start is None and not banner:
+                    start = out.tell() + len(parts[0]) + parts[1].startswith(b'\n')
+
+                out.writelines(parts)
+
+            with open_input(lhco) as raw, gunzip_if(raw, lhco.get('path') or lhco['member']) as f:
+                # blocks are cut before their last newline, so each event line follows a newline
+                rest = b'\n'
+                for data in iter(lambda: f.read(1 << 22), b''):
+                    block = rest + data
+                    end = block.rfind(b'\n')
+                    if end <= 0:
+                        rest = block
+                        continue
+                    write(block[:end])
+                    rest = block[end:]
+                write(rest if rest.endswith(b'\n') else rest + b'\n')
+
+            if start is None:
+                start = out.tell()
+            if 'slices' in lhco:
+                # previous merged file (incremental merge): its slices are kept, moved to where its events start
+                shift = start - lhco['slices'][0]['offset'] if lhco['slices'] else 0
+                slices.extend(dict(s, offset=s['offset'] + shift) for s in lhco['slices'])
+            else:
+                slices.append({ 'input': lhco.get('input'), 'member': lhco.get('member', os.path.basename(lhco.get('path', ''))),
+                                'first_event': first_event, 'nevents': nevents - first_event, 'offset': start, 'length': out.tell() - start })
+
+    return nevents, slices
+
+# Merge by run name (-d)
+# the job tarballs of a condor output directory are grouped by run name and each group is merged
+# by another call of this script in <output>/merged_<run_name>, running up to --max-merges at once
+def group_job_outputs(input_dir):
+    groups = {}
+    for path in sorted(glob.glob(f'{input_dir}/output_*.tar.gz') + glob.glob(f'{input_dir}/shower_*.tar.gz')):
+        name = get_run_name(path)
+        if name is not None:
+            groups.setdefault(name, []).append(path)
+    return groups
+
+def merge_group(name, files):
+    cmd = [ sys.executable, os.path.abspath(__file__), '-o', f'{output_file}/merged_{name}', '--fan-in', str(args.fan_in), '-i' ] + files
+    if args.jobs:
+        cmd += [ '-j', str(args.jobs) ]
+    cmd += [ '--fingerprint-events', str(args.fingerprint_events) ]
+    cmd += [ flag for flag, on in (('-e', args.extract_lhe), ('-k', args.keep_all), ('-u', args.incremental), ('--keep-duplicates', args.keep_duplicates)) if on ]
+
+    with open(f'{output_file}/merge_{name}.out', 'w') as out:
+        return subprocess.run(cmd, stdout=out, stderr=subprocess.STDOUT).returncode
+
+def read_merged_summary(path):
+    # number of events and total cross section from the header of the merged lhe
+    for lhe, opener in ((f'{path}/merged_unweighted_events.lhe.gz', gzip.open), (f'{path}/merged_unweighted_events.lhe', open)):
+        if os.path.exists(lhe):
+            with opener(lhe, 'rb') as f:
+                _, init, nevents = read_lhe_header(f)
+            return nevents, init_xsec(init)
+    return None, None
+
+def read_merged_losses(path):
+    # inputs of a group that are not in its merged files: skipped (errors reading them) and duplicates
+    # (excluded unless --keep-duplicates)
+    try:
+        with open(f'{path}/merge_manifest.json') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return 0, 0
+    return len(manifest.get('skipped', [])), 0 if args.keep_duplicates else len(manifest.get('duplicates', []))
+
+if args.input_dir:
+    groups = group_job_outputs(args.input_dir)
+    if not groups:
+        print(f'No job outputs found in {args.input_dir}')
+        raise SystemExit(1)
+
+    os.makedirs(output_file, exist_ok=True)
+    print(f'Merging {len(groups)} run names: {", ".join(groups)}')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_merges or os.cpu_count() or 1) as pool:
+        status = dict(zip(groups, pool.map(merge_group, groups, groups.values())))
+
+    summary = []
+    print(f'\n{"run name":30} {"jobs":>6} {"skipped":>7} {"dups":>5} {"status":>7} {"events":>10} {"xsec [pb]":>13}')
+    for name, files in groups.items():
+        nevents, xsec = read_merged_summary(f'{output_file}/merged_{name}')
+        merged = status[name] in (0, partial_exit_code)
+        nskipped, nduplicates = read_merged_losses(f'{output_file}/merged_{name}') if merged else (0, 0)
+        if not merged:
+            status_str = 'FAILED'
+        elif nskipped or nduplicates:
+            status_str = 'PARTIAL'
+        else:
+            status_str = 'OK'
+        summary.append({ 'run_name': name, 'njobs': len(files), 'skipped': nskipped, 'duplicates': nduplicates,
+                         'status': status_str.lower(), 'exit_code': status[name], 'nevents': nevents, 'xsec': xsec })
+        print(f'{name:30} {len(files):>6} {nskipped:>7} {nduplicates:>5} {status_str:>7} {"-" if nevents is None else nevents:>10} {"-" if xsec is None else f"{xsec:.6e}":>13}')
+
+    with open(f'{output_file}/merge_summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    # a group that failed or lost inputs is an error
+    raise SystemExit(0 if all(s['status'] == 'ok' for s in summary) else 1)
 
 # create tmp dir for uncompress files
-try:
-    os.mkdir(tmpdir)
-    os.mkdir(f'{tmpdir}/all')
-    os.mkdir(f'{tmpdir}/merged')
-except FileExistsError:
-    pass
-
-# Uncompress output
-for file in input_files:
-     os.system(f'tar -xzf {file} -C {tmpdir}/all')
-
-
-
-if os.environ['HOSTNAME'] == "jupiter.iflp.unlp.edu.ar":
+os.makedirs(f'{tmpdir}/all', exist_ok=True)
+os.makedirs(f'{tmpdir}/merged', exist_ok=True)
+
+# Read the job outputs
+# each tarball is scanned in a streaming pass: the metrics, lhe headers and fingerprints are read in memory
+# and only the files needed by hadd are written in tmpdir/all (everything with --keep-all). The lhe and
+# lhco events are not written either, they are read again from the tarball when merging (open_member)
+member_types = {
+    'lhe': re.compile(r'.*unweighted_events\.lhe\.gz'),
+    'root': re.compile(r'.*_delphes_events\.root'),
+    'lhco': re.compile(r'.*_delphes_events\.lhco(\.gz)?'),
+    'metrics': re.compile(r'.*_metrics\.json'),
+}
+
+def get_member_type(name):
+    for mtype, pattern in member_types.items():
+        if pattern.fullmatch(os.path.basename(name)):
+            return mtype
+    return None
+
+@contextlib.contextmanager
+def open_member(file, name):
+    # members of a tar.gz can only be reached reading it from the start
+    with tarfile.open(file, 'r|gz') as tar:
+        for member in tar:
+            if member.name == name:
+                yield tar.extractfile(member)
+                return
+    raise FileNotFoundError(f'{name} not found in {file}')
+
+class HashReader:
+    # file reader computing the sha256 of what is read
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+class LimitedReader:
+    # reader of the next length bytes of a file (e.g. a gzip member of a merged file)
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        reader = HashReader(f)
+        for _ in iter(lambda: reader.read(1 << 20), b''):
+            pass
+    return reader.sha256.hexdigest()
+
+# Duplicate inputs
+# jobs with the same seed (or submitted twice) have the same events: the fingerprint of each input
+# is the seed and the hash of its first events (from the lhe, or the lhco for shower jobs)
+re_lhe_seed = re.compile(rb'^\s*(\d+)\s*=\s*iseed', re.M)
+
+def is_lhe_event(line):
+    return line.lstrip().startswith(b'<event')
+
+def is_lhco_event(line):
+    return line.split()[:1] == [b'0']
+
+def hash_first_events(lines, is_event):
+    # sha256 of the lines of the first events, from the line where the first one starts
+    sha256 = hashlib.sha256()
+    n = 0
+    for line in lines:
+        if is_event(line):
+            n += 1
+            if n > args.fingerprint_events:
+                break
+        if n > 0:
+            sha256.update(line)
+    return sha256.hexdigest() if n > 0 else None
+
+# the 'data' filter is available since python 3.12 (and in the security updates of 3.8-3.11)
+extract_filter = { 'filter': 'data' } if hasattr(tarfile, 'data_filter') else {}
+
+def read_input(file):
+    found = { 'metrics': [], 'lhe': [], 'lhco': [], 'root': [] }
+    seed, events_hash = None, None
+    path_id = os.path.abspath(file)
+    try:
+        # the checksum of the tarball is computed in the same pass
+        with open(file, 'rb') as raw:
+            reader = HashReader(raw)
+            with tarfile.open(file, 'r|gz', fileobj=reader) as tar:
+                for member in tar:
+                    mtype = get_member_type(member.name) if member.isfile() else None
+                    if mtype == 'metrics':
+                        # the stream can't go back, so the member is read once and then written if needed
+                        content = tar.extractfile(member).read()
+                        found['metrics'].append(json.loads(content))
+                        if args.keep_all:
+                            with open(os.path.join(tmpdir, 'all', member.name), 'wb') as f:
+                                f.write(content)
+                    elif mtype == 'lhe' and not args.keep_all:
+                        # only the header is read here, the events are copied from the tarball when merging
+                        with gzip.GzipFile(fileobj=tar.extractfile(member)) as f:
+                            header, init, nevents = read_lhe_header(f)
+                            check_lhe_init(init)
+                            events_hash = hash_first_events(f, is_lhe_event)
+                        seed = re_lhe_seed.search(header)
+                        found['lhe'].append({ 'input': path_id, 'file': file, 'member': member.name, 'init': init, 'nevents': nevents })
+                    elif mtype == 'lhco' and not args.keep_all:
+                        if events_hash is None:
+                            events_hash = hash_first_events(gunzip_if(tar.extractfile(member), member.name), is_lhco_event)
+                        found['lhco'].append({ 'input': path_id, 'file': file, 'member': member.name })
+                    elif mtype is not None or args.keep_all:
+                        # members with absolute paths, links outside, ... are rejected as an error of the input
+                        tar.extract(member, f'{tmpdir}/all', **extract_filter)
+                        path = os.path.join(tmpdir, 'all', member.name)
+                        if mtype == 'lhe':
+                            with gzip.open(path) as f:
+                                header, init, nevents = read_lhe_header(f)
+                                check_lhe_init(init)
+                                events_hash = hash_first_events(f, is_lhe_event)
+                            seed = re_lhe_seed.search(header)
+                            found['lhe'].append({ 'input': path_id, 'member': member.name, 'path': path, 'init': init, 'nevents': nevents })
+                        elif mtype == 'lhco':
+                            if events_hash is None:
+                                with open(path, 'rb') as raw, gunzip_if(raw, path) as f:
+                                    events_hash = hash_first_events(f, is_lhco_event)
+                            found['lhco'].append({ 'input': path_id, 'member': member.name, 'path': path })
+                        elif mtype == 'root':
+                            found['root'].append(path)
+
+                for _ in iter(lambda: reader.read(1 << 20), b''):
+                    pass
+                found['sha256'] = reader.sha256.hexdigest()
+
+        # seed of the lhe banner, or of the job (shower jobs)
+        seed = seed.group(1).decode() if seed else next((m['seed'] for m in found['metrics'] if 'seed' in m), None)
+        found['seed'] = seed
+        found['fingerprint'] = hashlib.sha256(f'{seed}:{events_hash}'.encode()).hexdigest() if events_hash else None
+    except (tarfile.TarError, OSError, EOFError, ValueError) as e:
+        print(f'Error reading {file}: {e}. Skipping it\n', end='')
+        return None
+    return found
+
+jobs_metrics, jobs_lhe, jobs_lhco, jobs_root = [], [], [], []
+merged_inputs = []
+duplicates = []
+skipped = []
+fingerprints = { entry['fingerprint']: path for path, entry in manifest['inputs'].items() if entry.get('fingerprint') }
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    for file, found in zip(input_files, pool.map(read_input, input_files)):
+        if found is None:
+            skipped.append(os.path.abspath(file))
+            continue
+        if found['fingerprint'] in fingerprints:
+            duplicates.append({ 'input': os.path.abspath(file), 'duplicate_of': fingerprints[found['fingerprint']] })
+            if not args.keep_duplicates:
+                continue
+        elif found['fingerprint']:
+            fingerprints[found['fingerprint']] = os.path.abspath(file)
+        jobs_metrics.extend(found['metrics'])
+        jobs_lhe.extend(found['lhe'])
+        jobs_lhco.extend(found['lhco'])
+        jobs_root.extend(found['root'])
+        merged_inputs.append((file, { 'sha256': found['sha256'], 'seed': found['seed'], 'fingerprint': found['fingerprint'] }))
+
+# inputs that could not be read, they are not in the merged inputs so an incremental merge tries them again
+manifest['skipped'] = skipped
+if skipped:
+    print(f'{len(skipped)} inputs skipped (errors reading them)')
+
+if duplicates:
+    print(f'{len(duplicates)} inputs with the same events as another input ({"merged" if args.keep_duplicates else "excluded"}):')
+    for d in duplicates:
+        print(f'  {d["input"]} (duplicate of {d["duplicate_of"]})')
+    manifest['duplicates'] = [ d for d in manifest.get('duplicates', []) if d not in duplicates ] + duplicates
+
+# the merged lhe is one more input with the total number of events, so the cross sections
+# and errors recombined with the new files are the same as merging all the files again
+previous_metrics = None
+if args.incremental:
+    merged_lhe = f'{tmpdir}/merged_unweighted_events.lhe.gz'
+    if jobs_lhe and os.path.exists(merged_lhe):
+        with gzip.open(merged_lhe) as f:
+            _, init, nevents = read_lhe_header(f)
+        jobs_lhe.insert(0, { 'path': merged_lhe, 'init': init, 'nevents': nevents })
+        # with the slices of the manifest its inputs are kept as separate members
+        slices = manifest.get('lhe', {}).get('slices')
+        if slices and sum(s['nevents'] for s in slices) == nevents:
+            jobs_lhe[0]['slices'] = slices
+    if jobs_lhco and os.path.exists(f'{tmpdir}/merged_delphes_events.lhco'):
+        jobs_lhco.insert(0, { 'path': f'{tmpdir}/merged_delphes_events.lhco' })
+        if manifest.get('lhco', {}).get('slices'):
+            jobs_lhco[0]['slices'] = manifest['lhco']['slices']
+    if jobs_root and os.path.exists(f'{tmpdir}/merged_delphes_events.root'):
+        jobs_root.insert(0, f'{tmpdir}/merged_delphes_events.root')
+    if jobs_metrics and os.path.exists(f'{tmpdir}/metrics.json'):
+        with open(f'{tmpdir}/metrics.json') as f:
+            previous_metrics = json.load(f)
+
+
+
+if os.environ.get('HOSTNAME') == "jupiter.iflp.unlp.edu.ar":
     use_docker = False
     image = '/mnt/R5/images/mg-pythia-delphes-latest.sif'
 else:
     use_docker = True
     image = 'franaln/mg-pythia-delphes:latest'
 
+# commands that need the container are collected and run together in a single container
+# launch (the login environment is sourced only once), before packaging the merged outputs
+container_cmds = []
+# files the commands must produce
+container_outputs = []
+
 def run_cmd(cmd):
+    container_cmds.append(cmd)
+
+def run_container_cmds(cmds, outputs):
+    script = f'{tmpdir}/merge_cmds.sh'
+    with open(script, 'w') as f:
+        f.write('set -e\n')
+        f.write('\n'.join(cmds) + '\n')
+
     if use_docker:
-        os.system(f'docker run --rm -u $UID:$GROUPS -v $PWD/{tmpdir}:/home/docker/work/{tmpdir} {image} {cmd}')
+        # tmpdir is mounted in the same path, so the paths of the commands are the same in the container.
+        # The image entrypoint is bash -l -c, the command must be a single argument
+        workdir = os.path.abspath(tmpdir)
+        cmd = [ 'docker', 'run', '--rm', '-u', f'{os.getuid()}:{os.getgid()}', '-v', f'{workdir}:{workdir}', '-w', os.getcwd(), image, f'bash {script}' ]
     else:
-        os.system(f'apptainer exec {image} /bin/bash -l -c "{cmd}"')
+        cmd = [ 'apptainer', 'exec', image, '/bin/bash', '-l', script ]
+
+    try:
+        sc = subprocess.run(cmd).returncode
+    except FileNotFoundError:
+        print(f'Error: {cmd[0]} not found')
+        sc = 1
+    os.remove(script)
+
+    # hadd can fail leaving an empty file
+    missing = [ output for output in outputs if not os.path.exists(output) or os.path.getsize(output) == 0 ]
+    if sc != 0 or missing:
+        print(f'Error running the merge commands in the container (exit code {sc}' + (f', missing or empty {", ".join(missing)})' if missing else ')'))
+        return False
+    return True
+
+# Collect job metrics
+def collect_metrics(jobs_metrics, previous=None):
+    # previous: metrics collected by a previous merge, the new jobs are added to them
+    stages = previous['stages'] if previous else {}
+    for metrics in jobs_metrics:
+        for name, stage in metrics['stages'].items():
+            total = stages.setdefault(name, { 'njobs': 0, 'wall_time': 0., 'max_wall_time': 0., 'cpu_time': 0., 'max_rss': 0, 'bytes_written': 0 })
+            total['njobs'] += 1
+            total['wall_time'] += stage['wall_time']
+            total['max_wall_time'] = max(total['max_wall_time'], stage['wall_time'])
+            total['cpu_time'] += stage['cpu_time']
+            total['max_rss'] = max(total['max_rss'], stage['max_rss'])
+            total['bytes_written'] += stage['bytes_written']
+            for subname, substage in stage.get('substages', {}).items():
+                subtotal = total.setdefault('substages', {}).setdefault(subname, { 'njobs': 0, 'wall_time': 0. })
+                subtotal['njobs'] += 1
+                subtotal['wall_time'] += substage['wall_time']
+
+    return { 'njobs': len(jobs_metrics) + (previous['njobs'] if previous else 0), 'stages': stages }
+
+if len(jobs_metrics) > 0:
+
+    print("Collecting job metrics")
+
+    metrics = collect_metrics(jobs_metrics, previous_metrics)
+    with open(f'{tmpdir}/merged/metrics.json', 'w') as f:
+        json.dump(metrics, f, indent=2)
+
+    print(f'{"stage":16} {"njobs":>6} {"mean wall [s]":>14} {"max wall [s]":>13} {"mean cpu [s]":>13} {"max rss [MB]":>13} {"written [MB]":>13}')
+    for name, stage in metrics['stages'].items():
+        n = stage['njobs']
+        print(f'{name:16} {n:>6} {stage["wall_time"]/n:>14.1f} {stage["max_wall_time"]:>13.1f} {stage["cpu_time"]/n:>13.1f} {stage["max_rss"]/1e6:>13.1f} {stage["bytes_written"]/1e6:>13.1f}')
+        for subname, substage in stage.get('substages', {}).items():
+            print(f'  {subname:14} {substage["njobs"]:>6} {substage["wall_time"]/substage["njobs"]:>14.1f}')
 
 # Merge lhe
-files_lhe = glob.glob(f'{tmpdir}/all/*unweighted_events.lhe.gz')
-if len(files_lhe) > 0:
+if len(jobs_lhe) > 0:
 
     print("Merging lhe files")
 
-    cmd_merge_lhe = f"/mg_pythia_delphes/MG5_aMC/Template/LO/bin/internal/merge.pl {tmpdir}/all/*unweighted_events.lhe.gz {tmpdir}/merged/merged_unweighted_events.lhe.gz {tmpdir}/all/banner.txt"
+    nevents, xsec, slices = merge_lhe(jobs_lhe, f'{tmpdir}/merged/merged_unweighted_events.lhe.gz')
+    print(f'{len(jobs_lhe)} files, {nevents} events, cross section = {xsec:.6e} pb')
 
-    run_cmd(cmd_merge_lhe)
+    manifest['lhe'] = { 'file': 'merged_unweighted_events.lhe.gz', 'nevents': nevents, 'xsec': xsec, 'slices': slices }
 
 # Merge root
-files_root = glob.glob(f'{tmpdir}/all/*_delphes_events.root')
+def get_hadd_cmds(files, output, fan_in, workers):
+    """
+    Tree reduction: the files are merged in groups of fan_in in parallel (xargs -P), then the
+    outputs of each level in the same way until a single file is left. The inputs of each
+    hadd call are given in a file list (@list), so there is no limit in the number of files
+    """
+    hadd_dir = f'{tmpdir}/hadd'
+    os.makedirs(hadd_dir, exist_ok=True)
+
+    cmds = []
+    level = 0
+    while len(files) > fan_in:
+        level += 1
+        calls = []
+        outputs = []
+        for i in range(0, len(files), fan_in):
+            name = f'{hadd_dir}/level{level}_{i // fan_in}'
+            with open(f'{name}.txt', 'w') as f:
+                f.write('\n'.join(files[i:i+fan_in]) + '\n')
+            calls.append(f'{name}.root @{name}.txt')
+            outputs.append(f'{name}.root')
+
+        with open(f'{hadd_dir}/level{level}.txt', 'w') as f:
+            f.write('\n'.join(calls) + '\n')
+        cmds.append(f'xargs -P {workers} -L 1 hadd -f < {hadd_dir}/level{level}.txt')
+        files = outputs
+
+    with open(f'{hadd_dir}/final.txt', 'w') as f:
+        f.write('\n'.join(files) + '\n')
+    cmds.append(f'hadd -f {output} @{hadd_dir}/final.txt')
+    cmds.append(f'rm -r {hadd_dir}')
+
+    return cmds
+
+files_root = jobs_root
 if len(files_root) > 0:
 
     print("Merging root files")
 
-    cmd_merge_root = f"hadd {tmpdir}/merged/merged_delphes_events.root {tmpdir}/all/*_delphes_events.root"
-
-    run_cmd(cmd_merge_root)
+    merged_root = f'{tmpdir}/merged/merged_delphes_events.root'
+    for cmd in get_hadd_cmds(files_root, merged_root, max(args.fan_in, 2), args.jobs or os.cpu_count() or 1):
+        run_cmd(cmd)
+    container_outputs.append(merged_root)
 
 # Merge lhco
-files_lhco = glob.glob(f'{tmpdir}/all/*_delphes_events.lhco')
-if len(files_lhco) > 0:
+if len(jobs_lhco) > 0:
 
     print("Merging lhco files")
 
-    if os.path.exists(f'{tmpdir}/merged/merged_delphes_events.root'):
-        cmd_merge_lhco = f"lhco2root {tmpdir}/merged_delphes_events.root {tmpdir}/all/*_delphes_events.lhco && root2lhco {tmpdir}/merged_delphes_events.root {tmpdir}/merged/merged_delphes_events.lhco && rm {tmpdir}/merged_delphes_events.root"
-    else:
-        cmd_merge_lhco = f"root2lhco {tmpdir}/merged/merged_delphes_events.root {tmpdir}/merged/merged_delphes_events.lhco"
+    nevents, slices = merge_lhco(jobs_lhco, f'{tmpdir}/merged/merged_delphes_events.lhco')
+    print(f'{len(jobs_lhco)} files, {nevents} events')
+
+    manifest['lhco'] = { 'file': 'merged_delphes_events.lhco', 'nevents': nevents, 'slices': slices }
 
-    run_cmd(cmd_merge_lhco)
+merge_ok = True
+if container_cmds:
+    merge_ok = run_container_cmds(container_cmds, container_outputs)
 
 
 if args.extract_lhe:
@@ -96,6 +800,30 @@ if args.extract_lhe:
             os.system(f'gzip -d {lhe}')
     if os.path.exists(f'{tmpdir}/merged/merged_unweighted_events.lhe.gz'):
         os.system(f'gzip -d {tmpdir}/merged/merged_unweighted_events.lhe.gz')
+        # the events of each input are then read with data_offset/data_length
+        manifest['lhe']['file'] = 'merged_unweighted_events.lhe'
+
+# the inputs are not recorded as merged in the manifest (and a -d group or a DAG merge node fails)
+if not merge_ok:
+    if args.incremental:
+        print(f'The previous merged files in {tmpdir} are kept, the new ones are in {tmpdir}/merged')
+    else:
+        print(f'The merged files are kept in {tmpdir}/merged, without a manifest')
+    raise SystemExit(1)
+
+
+# Manifest
+# merged inputs (checksum and seed, also used by the incremental merge), slice of the merged
+# lhe and lhco files with the events of each input, and checksum of the merged files
+for file, info in merged_inputs:
+    manifest['inputs'][os.path.abspath(file)] = dict(input_id(file), **info)
+
+outputs = manifest.setdefault('outputs', {})
+for path in sorted(glob.glob(f'{tmpdir}/merged/*')):
+    outputs[os.path.basename(path)] = { 'size': os.path.getsize(path), 'sha256': file_sha256(path) }
+
+with open(f'{tmpdir}/merged/merge_manifest.json', 'w') as f:
+    json.dump(manifest, f, indent=2)
 
 
 if output_file.endswith('.tar.gz'):
@@ -106,4 +834,8 @@ else:
     os.system(f'rm -r {tmpdir}/merged')
 
 if not args.keep_all:
-    os.system(f'rm -r {tmpdir}/all')
\ No newline at end of file
+    os.system(f'rm -r {tmpdir}/all')
+
+if skipped:
+    print(f'ERROR: {len(skipped)} inputs skipped, they are not in the merged files')
+    raise SystemExit(partial_exit_code)
\ No newline at end of file
@@ -31,6 +31,11 @@ for file in ${input_files} ; do
     tar -xzf $file -C $tmpdir/all
 done
 
+# lhco files are compressed in the job outputs
+for file in ${tmpdir}/all/*.lhco.gz ; do
+    [ -f $file ] && gzip -d $file
+done
+
 
 if [[ "$HOSTNAME" == "jupiter.iflp.unlp.edu.ar" ]] ; then
     use_docker=false
@@ -4,8 +4,28 @@ import os
 import sys
 import argparse
 import string
+import io
+import re
+import json
 import yaml
+import time
+import queue
 import shutil
+import tempfile
+import glob
+import math
+import random
+import gzip
+import tarfile
+import hashlib
+import datetime
+import itertools
+import functools
+import threading
+import subprocess
+import asyncio
+import abc
+import concurrent.futures
 
 
 template_run_mg = """# run.mg5
@@ -41,6 +61,7 @@ container_image = ${container_image}
 
 executable = run_mg_pythia_delphes.sh
 
+shared_input_file = ${shared_input_file}
 input_file = ${input_file}
 job_name = $$(Cluster)_$$(Process)
 output_name = output_$$(run_name)_$$(job_name)
@@ -52,21 +73,275 @@ error       = job_$$(run_name)_$$(job_name).err
 log         = job_$$(run_name)_$$(job_name).log
 
 should_transfer_files = YES
-transfer_input_files = $$(input_file)
+transfer_input_files = $$(shared_input_file),$$(input_file)
 
 transfer_output_files = $$(output_name).tar.gz
 when_to_transfer_output = ON_EXIT
 
 ${requirements}
 
+${resources}
+
+${environment}
+
+${jobs}
+
+"""
+
+template_merge_desc = """# MG+Pythia+Delphes - merge job submission file (DAG node)
+
+universe = local
+getenv = True
+
+executable = merge_mg_pythia_delphes_output.py
+arguments  = -i output_$$(run_name)_*.tar.gz shower_$$(run_name)_*.tar.gz -r $$(run_name) -o merged_$$(run_name)
+
+output      = merge_$$(run_name).out
+error       = merge_$$(run_name).err
+log         = merge_$$(run_name).log
+
+queue
+"""
+
+template_post_desc = """# MG+Pythia+Delphes - ${post_name} job submission file (DAG node)
+
+universe = container
+container_image = ${container_image}
+
+executable = run_dag_post.sh
+arguments  = ${arguments}
+
+initialdir  = merged_$$(run_name)
+output      = ${post_name}_$$(run_name).out
+error       = ${post_name}_$$(run_name).err
+log         = ${post_name}_$$(run_name).log
+
+should_transfer_files = YES
+transfer_input_files = ${input_files}
+
+transfer_output_files = ${output_files}
+when_to_transfer_output = ON_EXIT
+
+queue
+"""
+
+template_shower_desc = """# MG+Pythia+Delphes - shower (Pythia8+Delphes) job submission file (DAG node)
+
+universe = container
+container_image = ${container_image}
+
+executable = run_shower.sh
+
+run_name = ${run_name}
+outputs = ${outputs}
+shared_input_file = ${shared_input_file}
+job_name = $$(Cluster)_$$(Process)
+output_name = shower_$$(run_name)_$$(job_name)
+
+# a different seed for each job, the generation outputs are only known when the node is submitted
+shower_seeds = ${seeds}
+seed = $$CHOICE(Process, shower_seeds)
+
+arguments  = $$(run_name) $$(input_file) $$(outputs) $$(output_name) $$(shared_input_file) $$(seed) $$(Step) ${shower_jobs}
+
+output      = shower_$$(run_name)_$$(job_name).out
+error       = shower_$$(run_name)_$$(job_name).err
+log         = shower_$$(run_name)_$$(job_name).log
+
+should_transfer_files = YES
+transfer_input_files = $$(shared_input_file),$$(input_file)
+
+transfer_output_files = $$(output_name).tar.gz
+when_to_transfer_output = ON_EXIT
+
+${requirements}
+
+${resources}
+
 ${jobs}
+"""
+
+template_run_dag_post_script = """#!/bin/bash
+
+script=$1
+shift
+
+if [ -z ${MG_DIR+x} ] ; then
+    source /setup_mg_pythia_delphes.sh
+fi
+
+echo "> Running ${script} $@, $(date)"
+python3 ${script} "$@"
+"""
+
+template_job_metrics_script = """#! /usr/bin/env python3
+
+# Run a job stage measuring wall time, cpu time, peak rss and bytes written, and save them in metrics.json
+#
+# job_metrics.py metrics.json --init key=value ...
+# job_metrics.py metrics.json <stage> <cmd> ...
+# job_metrics.py metrics.json --split <stage> <substage>=<file pattern> ...
+
+import os
+import sys
+import json
+import glob
+import time
+import resource
+import subprocess
+
+def read_io():
+    # reaped children are accounted in /proc/self/io
+    try:
+        with open('/proc/self/io') as f:
+            return { key: int(value) for key, value in (line.split(':') for line in f) }
+    except OSError:
+        return {}
+
+metrics_file = sys.argv[1]
+
+if os.path.exists(metrics_file):
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+else:
+    metrics = { 'stages': {} }
+
+sc = 0
+if sys.argv[2] == '--init':
+    metrics.update(arg.split('=', 1) for arg in sys.argv[3:])
+
+elif sys.argv[2] == '--split':
+    # wall time of the parts of a stage from the modification time of the files they write
+    stage = metrics['stages'][sys.argv[3]]
+    ends = []
+    for arg in sys.argv[4:]:
+        name, pattern = arg.split('=', 1)
+        files = glob.glob(pattern)
+        if files:
+            ends.append((os.path.getmtime(files[0]), name))
+
+    substages = {}
+    start = stage['start']
+    for end, name in sorted(ends):
+        substages[name] = { 'wall_time': end - start }
+        start = end
+    stage['substages'] = substages
+
+else:
+    stage = sys.argv[2]
+
+    io_start = read_io()
+    t_start = time.time()
+
+    sc = subprocess.call(sys.argv[3:])
+
+    t_end = time.time()
+    io_end = read_io()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    metrics['stages'][stage] = {
+        'start': t_start,
+        'wall_time': t_end - t_start,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'max_rss': usage.ru_maxrss * 1024,
+        'bytes_written': io_end.get('wchar', 0) - io_start.get('wchar', 0),
+        'exit_code': sc,
+    }
+
+with open(metrics_file, 'w') as f:
+    json.dump(metrics, f, indent=2)
+
+sys.exit(sc)
+"""
+
+template_package_outputs_script = """#! /usr/bin/env python3
+
+# Package the job outputs with a compression policy for each output type: files already compressed
+# (.gz, .root) are stored as they are, text outputs (lhco, logs) are compressed with pigz
+# (multithreaded) if available or python gzip, and the sha256 checksums of the members are written
+# in <dir>. With --gzip, the files written after the tar stage (metrics) are added, then the
+# checksum file as the last member, and the tarball is wrapped in a gzip stream without
+# compression, so nothing is compressed twice
+#
+# package_outputs.py <output_name>.tar <dir> <file or dir> ...
+# package_outputs.py --gzip <output_name>.tar <dir> <file> ...
+
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import tarfile
+import subprocess
 
+compress_types = ('.lhco', '_logs.tar')
+
+def compress(path):
+    if shutil.which('pigz'):
+        subprocess.check_call(['pigz', '-f', path])
+    else:
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb', compresslevel=6) as out:
+            shutil.copyfileobj(f, out, 1 << 20)
+        os.remove(path)
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def checksums_name(tar_path):
+    return os.path.basename(tar_path)[:-len('.tar')] + '_checksums.sha256'
+
+def add_files(tar_path, directory, members, mode):
+    # same format as sha256sum, to check the files with sha256sum -c
+    with open(os.path.join(directory, checksums_name(tar_path)), mode) as f:
+        for name in members:
+            f.write(f'{sha256(os.path.join(directory, name))}  {name}\\n')
+
+    with tarfile.open(tar_path, mode) as tar:
+        for name in members:
+            tar.add(os.path.join(directory, name), arcname=name)
+            print(name)
+
+if sys.argv[1] == '--gzip':
+    tar_path, directory = sys.argv[2], sys.argv[3]
+    add_files(tar_path, directory, sys.argv[4:], 'a')
+    with tarfile.open(tar_path, 'a') as tar:
+        tar.add(os.path.join(directory, checksums_name(tar_path)), arcname=checksums_name(tar_path))
+
+    with open(tar_path, 'rb') as f, gzip.open(tar_path + '.gz', 'wb', compresslevel=0) as out:
+        shutil.copyfileobj(f, out, 1 << 20)
+    os.remove(tar_path)
+    sys.exit(0)
+
+tar_path, directory = sys.argv[1], sys.argv[2]
+
+files = []
+for name in sys.argv[3:]:
+    path = os.path.join(directory, name)
+    if os.path.isdir(path):
+        for root, _, names in os.walk(path):
+            files.extend(os.path.relpath(os.path.join(root, n), directory) for n in sorted(names))
+    else:
+        files.append(os.path.normpath(name))
+
+members = []
+for name in files:
+    if name.endswith(compress_types):
+        compress(os.path.join(directory, name))
+        name += '.gz'
+    members.append(name)
+
+add_files(tar_path, directory, members, 'w')
 """
 
 template_run_local_script = """#!/bin/bash
 
 run_name=$1
 run_dir=$2
+seed=$3
 
 echo -e ">>> Running run_mg_pythia_delphes.sh with the following configuration:\n"
 echo "date          = "$(date)
@@ -75,19 +350,41 @@ echo "current dir   = "$PWD
 echo ""
 echo "run_name      = "${run_name}
 echo "run_dir       = "${run_dir}
+echo "seed          = "${seed}
 echo ""
 
 job_dir=$PWD
 
+run_stage() {
+    python3 ${job_dir}/job_metrics.py ${job_dir}/metrics.json "$@"
+}
+
+run_stage --init run_name=${run_name} hostname=${HOSTNAME}
+
 # echo "> Moving to run_directory ${run_dir}"
 # cd ${run_dir}
 
-if grep -Fxq "set iseed = RANDOM" run.mg5 ; then
+if [ -n "${seed}" ] ; then
+    echo "Setting seed = ${seed}"
+    sed -i "/^set iseed = /d" run.mg5
+    sed -i "s|^done$|set iseed = ${seed}\\ndone|" run.mg5
+elif grep -Fxq "set iseed = RANDOM" run.mg5 ; then
     random_seed=${RANDOM}
     echo "Setting random seed = ${random_seed}"
     sed -i "s|set iseed = RANDOM|set iseed = ${random_seed}|g" run.mg5
 fi
 
+# save the seed used with the job outputs
+run_stage --init seed=$(sed -n "s/^set iseed = //p" run.mg5)
+
+# ncores = all: use all the cpus available
+if grep -Fxq "set nb_core None" run.mg5 ; then
+    ncores=$(nproc)
+    echo "Setting nb_core = ${ncores}"
+    sed -i "s|^set nb_core None$|set nb_core ${ncores}|" run.mg5
+    run_stage --init ncores=${ncores}
+fi
+
 echo "> Runnning MG+Pythia+Delphes "
 
 if [ -z ${MG_DIR+x} ] ; then
@@ -96,7 +393,8 @@ fi
 
 run_dir=${job_dir}/RUN
 
-mg5_aMC run.mg5
+run_stage madgraph mg5_aMC run.mg5
+sc=$?
 
 if [ -d ${run_dir}/Events/run_01_decayed_1 ] ; then
     output_dir_name=run_01_decayed_1
@@ -106,9 +404,15 @@ fi
 
 output_dir=${run_dir}/Events/${output_dir_name}
 
+# MG/MadSpin/Pythia/Delphes run in the same mg5_aMC call, split its wall time using their outputs
+run_stage --split madgraph \\
+    "generation=${run_dir}/Events/run_01/unweighted_events.lhe*" \\
+    "madspin=${run_dir}/Events/run_01_decayed_1/unweighted_events.lhe*" \\
+    "pythia8=${output_dir}/*_pythia8_events.hepmc*" \\
+    "delphes=${output_dir}/*_delphes_events.root"
+
 
 # Check if something failed (in that case save debug output and exit)
-sc=$?
 if [ $sc -ne 0 ] || [ -f "${mg_debug_file}" ] ;  then
     echo "ERROR running MG. Exiting ..."
     tar -czf ${output_file} -C ${output_dir} *
@@ -127,6 +431,8 @@ run_name=$1
 input_file=$2
 outputs=$3
 output_name=$4
+shared_input_file=$5
+seed=$6
 
 output_file=${output_name}.tar.gz
 
@@ -137,6 +443,8 @@ echo "current dir   = "$PWD
 echo ""
 echo "run_name      = "${run_name}
 echo "input_file    = "${input_file}
+echo "shared_input  = "${shared_input_file}
+echo "seed          = "${seed}
 echo "outputs       = "${outputs}
 echo "output_name   = "${output_name}
 echo "output_file   = "${output_file}
@@ -144,17 +452,50 @@ echo ""
 
 job_dir=$PWD
 
+run_stage() {
+    python3 ${job_dir}/job_metrics.py ${job_dir}/metrics.json "$@"
+}
+
 echo "> Preparing input files "
+if [ -n "${shared_input_file}" ] ; then
+    tar -xzmf ${shared_input_file}
+    rm ${shared_input_file}
+fi
 tar -xzmf ${input_file}
 rm ${input_file}
 ls
 
-if grep -Fxq "set iseed = RANDOM" run.mg5 ; then
+run_stage --init run_name=${run_name} output_name=${output_name} hostname=${HOSTNAME}
+
+if [ -n "${seed}" ] ; then
+    echo "Setting seed = ${seed}"
+    sed -i "/^set iseed = /d" run.mg5
+    sed -i "s|^done$|set iseed = ${seed}\\ndone|" run.mg5
+elif grep -Fxq "set iseed = RANDOM" run.mg5 ; then
     random_seed=${RANDOM}
     echo "Setting random seed = ${random_seed}"
     sed -i "s|set iseed = RANDOM|set iseed = ${random_seed}|g" run.mg5
 fi
 
+# save the seed used with the job outputs
+run_stage --init seed=$(sed -n "s/^set iseed = //p" run.mg5)
+
+# ncores = all: use the cpus allocated to the slot
+if grep -Fxq "set nb_core None" run.mg5 ; then
+    if [ -f "${_CONDOR_MACHINE_AD}" ] ; then
+        ncores=$(awk '/^Cpus = /{print $3}' ${_CONDOR_MACHINE_AD})
+    fi
+    ncores=${ncores:-${OMP_NUM_THREADS:-$(nproc)}}
+    echo "Setting nb_core = ${ncores}"
+    sed -i "s|^set nb_core None$|set nb_core ${ncores}|" run.mg5
+    run_stage --init ncores=${ncores}
+fi
+
+# expert.parallel_shower (set in the job description): MG stops after the generation, also for input dirs
+if [ -n "${PARALLEL_SHOWER_CHUNKS}" ] ; then
+    sed -i -e "s|^shower=.*$|shower=OFF|" -e "/^detector=/d" run.mg5
+fi
+
 echo "> Runnning MG+Pythia+Delphes "
 
 if [ -z ${MG_DIR+x} ] ; then
@@ -163,7 +504,8 @@ fi
 
 run_dir=${job_dir}/RUN
 
-mg5_aMC run.mg5
+run_stage madgraph mg5_aMC run.mg5
+sc=$?
 
 if [ -d ${run_dir}/Events/run_01_decayed_1 ] ; then
     output_dir_name=run_01_decayed_1
@@ -173,8 +515,14 @@ fi
 
 output_dir=${run_dir}/Events/${output_dir_name}
 
+# MG/MadSpin/Pythia/Delphes run in the same mg5_aMC call, split its wall time using their outputs
+run_stage --split madgraph \\
+    "generation=${run_dir}/Events/run_01/unweighted_events.lhe*" \\
+    "madspin=${run_dir}/Events/run_01_decayed_1/unweighted_events.lhe*" \\
+    "pythia8=${output_dir}/*_pythia8_events.hepmc*" \\
+    "delphes=${output_dir}/*_delphes_events.root"
+
 # Check if something failed (in that case save debug output and exit)
-sc=$?
 if [ $sc -ne 0 ] || [ -f "${mg_debug_file}" ] ;  then
     echo "ERROR running MG. Exiting ..."
     tar -czf ${output_file} -C ${output_dir} *
@@ -185,6 +533,59 @@ ls ${output_dir}
 
 echo "Finished running MG+Pythia+Delphes, $(date)"
 
+# Pythia8+Delphes in parallel over chunks of the LHE events (expert.parallel_shower), one for each requested cpu
+if [ -n "${PARALLEL_SHOWER_CHUNKS}" ] ; then
+
+    nchunks=${PARALLEL_SHOWER_CHUNKS}
+    job_seed=$(sed -n "s/^set iseed = //p" run.mg5)
+
+    shower_chunks() {
+        gzip -dc ${output_dir}/unweighted_events.lhe.gz > events.lhe
+        nevents=$(grep -c "<event>" events.lhe)
+        chunk=$(( (nevents + nchunks - 1) / nchunks ))
+        echo "Showering ${nevents} events in ${nchunks} chunks of ${chunk} events"
+
+        # seeds of different jobs are seed_stride (100) apart and nchunks is at most seed_stride,
+        # so seed + i is not used by any other job
+        pids=()
+        for (( i=0; i<nchunks && i*chunk<nevents; i++ )) ; do
+            cp cards/pythia8_card.dat shower_${i}.cmnd
+            cat >> shower_${i}.cmnd << EOF
+Main:numberOfEvents = ${chunk}
+Beams:frameType = 4
+Beams:LHEF = events.lhe
+Beams:nSkipLHEFatInit = $(( i * chunk ))
+Random:setSeed = on
+Random:seed = $(( job_seed + i ))
+EOF
+            DelphesPythia8 cards/delphes_card.dat shower_${i}.cmnd shower_${i}.root > shower_${i}.log 2>&1 &
+            pids+=($!)
+        done
+
+        failed=0
+        for pid in ${pids[@]} ; do
+            wait ${pid} || failed=1
+        done
+        rm events.lhe
+
+        if [ ${failed} -ne 0 ] ; then
+            tail -n 20 shower_*.log
+            return 1
+        fi
+
+        hadd -f ${output_dir}/${run_name}_delphes_events.root shower_*.root && rm shower_*.root
+    }
+    export -f shower_chunks
+    export output_dir run_name nchunks job_seed
+
+    run_stage pythia8_delphes bash -c shower_chunks
+    if [ $? -ne 0 ] ; then
+        echo "ERROR running Pythia8+Delphes. Exiting ..."
+        tar -czf ${output_file} -C ${job_dir} shower_*.log
+        exit 1
+    fi
+fi
+
 
 # Outputs
 echo "> Preparing outputs"
@@ -239,7 +640,7 @@ if [[ "${outputs}" =~ "lhco" ]] ; then
     output_file_lhco=${output_name}_delphes_events.lhco
     output_file_banner=${output_dir_name}_${run_name}_banner.txt
 
-    root2lhco ${output_dir}/${output_file_root} ${output_dir}/${output_file_tmp_lhco}
+    run_stage root2lhco root2lhco ${output_dir}/${output_file_root} ${output_dir}/${output_file_tmp_lhco}
 
     if [ ! -e ${output_dir}/${output_file_tmp_lhco} ]; then
         echo "ERROR: no lhco output file. Exiting ..."
@@ -257,9 +658,154 @@ if [[ "${outputs}" =~ "lhco" ]] ; then
 fi
 
 if [[ "${outputs}" =~ "all" ]] ; then
-    tar -czf ${output_file} -C ${output_dir} *
+    all_output_files=(.)
+fi
+
+# metrics are added after the tar stage so they include it, then the checksums and the tarball is
+# wrapped in gzip (the outputs are compressed, or not, by type in the tar stage)
+output_file_metrics=${output_name}_metrics.json
+
+run_stage tar_output python3 ${job_dir}/package_outputs.py ${output_name}.tar ${output_dir} ${all_output_files[@]}
+if [ $? -ne 0 ] ; then
+    echo "ERROR packaging the outputs. Exiting ..."
+    rm -f ${output_name}.tar
+    tar -czf ${output_file} -C ${job_dir} metrics.json
+    exit 1
+fi
+
+cp ${job_dir}/metrics.json ${output_dir}/${output_file_metrics}
+python3 ${job_dir}/package_outputs.py --gzip ${output_name}.tar ${output_dir} ${output_file_metrics}
+if [ $? -ne 0 ] ; then
+    echo "ERROR packaging the outputs. Exiting ..."
+    exit 1
+fi
+
+echo "Finished OK, $(date)"
+"""
+
+
+template_run_shower_script = """#!/bin/bash
+
+# Pythia8+Delphes over a slice of the LHE events of a generation job
+
+run_name=$1
+input_file=$(basename $2)
+outputs=$3
+output_name=$4
+shared_input_file=$5
+seed=$6
+slice=$7
+nslices=$8
+
+output_file=${output_name}.tar.gz
+
+echo -e ">>> Running run_shower.sh with the following configuration:\\n"
+echo "date          = "$(date)
+echo "hostname      = "$HOSTNAME
+echo "run_name      = "${run_name}
+echo "input_file    = "${input_file}
+echo "seed          = "${seed}
+echo "slice         = "${slice}/${nslices}
+echo "outputs       = "${outputs}
+echo "output_name   = "${output_name}
+echo ""
+
+job_dir=$PWD
+output_dir=${job_dir}/shower
+mkdir -p ${output_dir}
+
+run_stage() {
+    python3 ${job_dir}/job_metrics.py ${job_dir}/metrics.json "$@"
+}
+
+echo "> Preparing input files "
+tar -xzmf ${shared_input_file}
+rm ${shared_input_file}
+mkdir generation
+if [[ "${input_file}" == *.lhe.gz || "${input_file}" == *.lhe ]] ; then
+    mv ${input_file} generation/
 else
-    tar -cvzf ${output_file} -C ${output_dir} ${all_output_files[@]}
+    tar -xzmf ${input_file} -C generation
+    rm ${input_file}
+fi
+
+run_stage --init run_name=${run_name} output_name=${output_name} hostname=${HOSTNAME} seed=${seed} input=${input_file}
+
+lhe_file=$(ls generation/*.lhe.gz generation/*.lhe 2> /dev/null | grep -v before_decay | head -n 1)
+if [ -z "${lhe_file}" ] ; then
+    echo "ERROR: no lhe file in ${input_file}. Exiting ..."
+    tar -czf ${output_file} -C ${job_dir} metrics.json
+    exit 1
+fi
+
+run_stage unpack_lhe bash -c "gzip -dcf ${lhe_file} > events.lhe"
+
+# events of this slice
+nevents=$(grep -c "<event>" events.lhe)
+chunk=$(( (nevents + nslices - 1) / nslices ))
+skip=$(( slice * chunk ))
+if [ $(( skip + chunk )) -gt ${nevents} ] ; then
+    chunk=$(( nevents > skip ? nevents - skip : 0 ))
+fi
+echo "Showering ${chunk} events after skipping ${skip} of ${nevents}"
+
+# MG pythia8 card (settings not known by Pythia are ignored with a warning) + LHE input
+cp cards/pythia8_card.dat shower.cmnd
+cat >> shower.cmnd << EOF
+Main:numberOfEvents = ${chunk}
+Beams:frameType = 4
+Beams:LHEF = events.lhe
+Beams:nSkipLHEFatInit = ${skip}
+Random:setSeed = on
+Random:seed = ${seed}
+EOF
+
+if [ -z ${MG_DIR+x} ] ; then
+    source /setup_mg_pythia_delphes.sh
+fi
+
+output_file_root=${output_name}_delphes_events.root
+
+if [ ${chunk} -gt 0 ] ; then
+    run_stage pythia8_delphes DelphesPythia8 cards/delphes_card.dat shower.cmnd ${output_dir}/${output_file_root}
+    sc=$?
+    if [ $sc -ne 0 ] ; then
+        echo "ERROR running Pythia8+Delphes. Exiting ..."
+        tar -czf ${output_file} -C ${job_dir} metrics.json shower.cmnd
+        exit 1
+    fi
+fi
+rm events.lhe
+
+all_output_files=()
+
+## delphes .root
+if [[ "${outputs}" =~ "root" ]] && [ -f ${output_dir}/${output_file_root} ] ; then
+    all_output_files+=(${output_file_root})
+fi
+
+## LHCO (Delphes output)
+if [[ "${outputs}" =~ "lhco" ]] && [ -f ${output_dir}/${output_file_root} ] ; then
+    output_file_lhco=${output_name}_delphes_events.lhco
+    run_stage root2lhco root2lhco ${output_dir}/${output_file_root} ${output_dir}/${output_file_lhco}
+    all_output_files+=(${output_file_lhco})
+fi
+
+output_file_metrics=${output_name}_metrics.json
+
+run_stage tar_output python3 ${job_dir}/package_outputs.py ${output_name}.tar ${output_dir} ${all_output_files[@]}
+if [ $? -ne 0 ] ; then
+    echo "ERROR packaging the outputs. Exiting ..."
+    rm -f ${output_name}.tar
+    tar -czf ${output_file} -C ${job_dir} metrics.json
+    exit 1
+fi
+
+cp ${job_dir}/metrics.json ${output_dir}/${output_file_metrics}
+python3 ${job_dir}/package_outputs.py --gzip ${output_name}.tar ${output_dir} ${output_file_metrics}
+if [ $? -ne 0 ] ; then
+    echo "ERROR packaging the outputs. Exiting ..."
+    exit 1
 fi
 
 echo "Finished OK, $(date)"
@@ -298,32 +844,1314 @@ def get_config_options(config):
 
 def get_expert_options(config):
     config_options = []
-    if 'expert' in config:
-        opts = config['expert']
-        if 'mode' in opts:
-            if opts["mode"] == 'single':
-                config_options.append('set run_mode 0')
-            elif opts['mode'] == 'multi':
-                config_options.append('set run_mode 2')
-        if 'ncores' in opts:
-            if opts['ncores'].lower() == 'all':
-                opts['ncores'] = 'None'
-            config_options.append(f'set nb_core {opts["ncores"]}')
+    opts = config.get('expert', {})
+    # single mode unless asked (the condor jobs request 1 cpu)
+    if opts.get('mode') != 'multi':
+        config_options.append('set run_mode 0')
+        return config_options
+
+    config_options.append('set run_mode 2')
+    # the nb_core of the MG config of the images is 1, so it is always set. 'None' (ncores = all,
+    # the default) is replaced in the job by the number of cores allocated to it (request_cpus)
+    ncores = str(opts.get('ncores', 'all')).lower()
+    if ncores in ('all', 'none'):
+        config_options.append('set nb_core None')
+    else:
+        config_options.append(f'set nb_core {opts["ncores"]}')
 
     return config_options
 
+def get_matching_options(files):
+    """
+    Run card parameters of a run dir ({path: content}) that enable MLM matching or CKKW-L merging
+    (ickkw, xqcut, ktdurham, ptlund), with the set commands of run.mg5 overriding the run card.
+    They are applied by the MG Pythia8 interface, not by DelphesPythia8 (shower_jobs, parallel_shower)
+    """
+    values = {}
+    for path, content in files.items():
+        if path.endswith('run_card.dat'):
+            for line in content.decode(errors='replace').splitlines():
+                match = re.match(r'\s*([^!=\s]+)\s*=\s*(\w+)', line)
+                if match:
+                    values[match.group(2).lower()] = match.group(1)
+    for line in files.get('run.mg5', b'').decode(errors='replace').splitlines():
+        match = re.match(r'\s*set\s+(?:run_card\s+)?(\w+)\s*=?\s*(\S+)', line)
+        if match:
+            values[match.group(1).lower()] = match.group(2)
+
+    enabled = {}
+    for name, on in (('ickkw', lambda v: v != 0), ('xqcut', lambda v: v > 0), ('ktdurham', lambda v: v > 0), ('ptlund', lambda v: v > 0)):
+        try:
+            if on(float(values[name])):
+                enabled[name] = values[name]
+        except (KeyError, ValueError):
+            pass
+    return enabled
+
+@functools.lru_cache(maxsize=None)
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def read_file(path):
+    # cached, so cards shared by many run dirs are read only once
+    return _read_file(os.path.realpath(path))
+
+class FileContent(bytes):
+    # content of a file of an input dir, with its permission bits (e.g. executable scripts)
+    mode = 0o644
+
+def read_dir(path):
+    files = {}
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            content = FileContent(read_file(file_path))
+            content.mode = os.stat(file_path).st_mode & 0o777
+            files[os.path.relpath(file_path, path)] = content
+    return files
+
+def write_run_dir(run_dir, files):
+    for path, content in files.items():
+        file_path = os.path.join(run_dir, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        if isinstance(content, FileContent):
+            os.chmod(file_path, content.mode)
+
+def write_run_tarball(tar_path, files):
+    mtime = time.time()
+    with tarfile.open(tar_path, 'w:gz') as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            info.mtime = mtime
+            info.mode = getattr(content, 'mode', 0o644)
+            tar.addfile(info, io.BytesIO(content))
+
+def split_common_files(run_files):
+    """
+    Split the run dirs files in the ones identical in all run dirs and the
+    ones specific to each run dir. run.mg5 is always kept in the latter
+    """
+    files_list = list(run_files.values())
+
+    common_files = dict(files_list[0])
+    for files in files_list[1:]:
+        common_files = { path: content for path, content in common_files.items() if files.get(path) == content }
+    common_files.pop('run.mg5', None)
+
+    specific_files = {}
+    for name, files in run_files.items():
+        specific_files[name] = { path: content for path, content in files.items() if path not in common_files }
+
+    return common_files, specific_files
+
+def stage_run_dirs(run_dirs, run_files, compress, workers=None, common_path=None, common_files=None):
+    # zlib and file writes release the GIL, so threads are enough here
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        if common_path is not None:
+            futures.append(pool.submit(write_run_tarball, common_path, common_files))
+        for name, run_dir in run_dirs.items():
+            if compress:
+                futures.append(pool.submit(write_run_tarball, f'{run_dir}.tar.gz', run_files[name]))
+            else:
+                futures.append(pool.submit(write_run_dir, run_dir, run_files[name]))
+
+        for future in futures:
+            future.result()
+
+
+def get_fingerprint(files, options):
+    # hash of the run dir files (run.mg5 includes process and options) and the run options
+    h = hashlib.sha256()
+    for path in sorted(files):
+        h.update(path.encode() + b'\0')
+        h.update(hashlib.sha256(files[path]).digest())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+def load_fingerprints(output_dir):
+    path = f'{output_dir}/fingerprints.json'
+    if not os.path.exists(path):
+        return { 'shared': None, 'runs': {} }
+    with open(path) as f:
+        return json.load(f)
+
+def save_fingerprints(output_dir, fingerprints, failed=()):
+    # saved only after submitting, and without the runs that failed, so they are rebuilt the next time
+    fingerprints = dict(fingerprints, runs={ name: fp for name, fp in fingerprints['runs'].items() if name not in failed })
+    with open(f'{output_dir}/fingerprints.json', 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+
+def remove_run_outputs(output_dir, name):
+    # outputs and logs of a condor run: output_<name>_<cluster>_<proc>.tar.gz, job_<name>_<cluster>_<proc>.{log,out,err}
+    # and the same with shower_ for its shower jobs (the full suffix is matched, so the files of a run <name>_<N>
+    # are not removed)
+    pattern = re.compile(rf'(output|job|shower)_{re.escape(name)}_\d+_\d+\.(tar\.gz|log|out|err)')
+    for path in glob.glob(f'{output_dir}/*_{name}_*'):
+        if pattern.fullmatch(os.path.basename(path)):
+            os.remove(path)
+
+    # local run dir with all its outputs
+    run_dir = f'{output_dir}/run_{name}'
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+
+
+# --------------------
+#  Param card scans
+# --------------------
+
+def get_param_card_positions(lines):
+    # {(block, ids): line index} for all the parameters in a param card (DECAY widths use block 'DECAY')
+    positions = {}
+    block = None
+    for i, line in enumerate(lines):
+        tokens = line.split('#')[0].split()
+        if not tokens:
+            continue
+        if tokens[0].upper() == 'BLOCK':
+            block = tokens[1].upper()
+        elif tokens[0].upper() == 'DECAY':
+            positions[('DECAY', (int(tokens[1]),))] = i
+            block = None
+        elif block is not None:
+            try:
+                ids = tuple(int(t) for t in tokens[:-1])
+            except ValueError:
+                continue
+            positions[(block, ids)] = i
+    return positions
+
+def set_param_card_value(line, value):
+    # replace the value (last token before the comment) keeping the comment
+    data, sep, comment = line.partition('#')
+    tokens = data.split()
+    tokens[-1] = f'{value:e}'
+    if tokens[0].upper() == 'DECAY':
+        new_line = ' '.join(tokens)
+    else:
+        new_line = '      ' + ' '.join(tokens)
+    if sep:
+        new_line += ' #' + comment
+    return new_line
+
+def render_param_cards(lines, indices, points):
+    # points: list of values, in the same order as indices
+    cards = []
+    for values in points:
+        card_lines = list(lines)
+        for i, value in zip(indices, values):
+            card_lines[i] = set_param_card_value(card_lines[i], value)
+        cards.append('\n'.join(card_lines).encode())
+    return cards
+
+def get_scan_values(param, sampling):
+    if 'values' in param:
+        return [ float(v) for v in param['values'] ]
+    elif 'range' in param and sampling == 'grid':
+        vmin, vmax = param['range']
+        steps = int(param.get('steps', 2))
+        return [ vmin + i * (vmax - vmin) / (steps - 1) for i in range(steps) ] if steps > 1 else [ vmin ]
+    raise Exception(f'Error in param_scan: parameter {param["block"]} {param["id"]} needs "values" or "range" (+"steps")')
+
+def get_scan_points(config_scan):
+    """
+    List of points of the scan, each one a list with the value of each parameter.
+    sampling = grid (all combinations), list (values zipped) or lhs (latin hypercube in range)
+    """
+    sampling = config_scan.get('sampling', 'grid')
+    params = config_scan['parameters']
+
+    if sampling == 'grid':
+        return [ list(p) for p in itertools.product(*[ get_scan_values(param, sampling) for param in params ]) ]
+
+    elif sampling == 'list':
+        values = [ get_scan_values(param, sampling) for param in params ]
+        if len(set(len(v) for v in values)) != 1:
+            raise Exception('Error in param_scan: all parameters need the same number of values with sampling = list')
+        return [ list(p) for p in zip(*values) ]
+
+    elif sampling == 'lhs':
+        if 'npoints' not in config_scan:
+            raise Exception('Error in param_scan: sampling = lhs needs "npoints"')
+        npoints = int(config_scan['npoints'])
+        rng = random.Random(config_scan.get('seed', 0))
+        columns = []
+        for param in params:
+            if 'range' not in param or len(param['range']) != 2:
+                raise Exception(f'Error in param_scan: parameter {param["block"]} {param["id"]} needs "range" ([min, max]) with sampling = lhs')
+            vmin, vmax = param['range']
+            strata = list(range(npoints))
+            rng.shuffle(strata)
+            columns.append([ vmin + (k + rng.random()) / npoints * (vmax - vmin) for k in strata ])
+        return [ list(p) for p in zip(*columns) ]
+
+    raise Exception(f'Error in param_scan: unknown sampling {sampling}. Use grid, list or lhs')
+
+def get_scan_param_cards(config_scan):
+    """
+    Param cards for all the points of the scan ({point name: (card content, values)}), rendered
+    in memory from the base card
+    """
+    lines = open(config_scan['base']).read().split('\n')
+    positions = get_param_card_positions(lines)
+
+    indices = []
+    labels = []
+    for param in config_scan['parameters']:
+        ids = param['id'] if isinstance(param['id'], list) else [ param['id'] ]
+        key = (str(param['block']).upper(), tuple(int(i) for i in ids))
+        if key not in positions:
+            raise Exception(f'Error in param_scan: parameter {key[0]} {" ".join(map(str, key[1]))} not found in {config_scan["base"]}')
+        indices.append(positions[key])
+        labels.append(param.get('name', f'{key[0]}_{"_".join(map(str, key[1]))}'))
+
+    points = get_scan_points(config_scan)
+    cards = render_param_cards(lines, indices, points)
+
+    ndigits = len(str(len(points) - 1))
+    scan = {}
+    for i, (card, values) in enumerate(zip(cards, points)):
+        scan[f'p{i:0{ndigits}d}'] = (card, dict(zip(labels, values)))
+
+    return scan
+
+
+# -----------
+#  Resources
+# -----------
+
+default_memory = 2048
+default_multicore_cpus = 8
+memory_headroom = 1.5
+
+def get_past_max_rss(paths):
+    # max rss of all stages in job (or merged) metrics.json files
+    max_rss = 0
+    for path in paths:
+        try:
+            with open(path) as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for stage in metrics.get('stages', {}).values():
+            max_rss = max(max_rss, stage.get('max_rss', 0))
+    return max_rss
+
+def get_job_resources(config, output_dir):
+    """
+    request_cpus and request_memory (MB) for the jobs. cpus follow expert.mode/ncores
+    (run.cpus overrides it, and sets the cpus of ncores = all, default 8) and memory is tuned from previous metrics.json if available
+    (run.metrics or the merged outputs in output_dir), unless run.memory is given
+    """
+    config_run = config['run']
+    expert = config.get('expert', {})
+
+    multi = expert.get('mode') == 'multi'
+    ncores = str(expert.get('ncores', 'all')).lower()
+
+    if 'cpus' in config_run:
+        cpus = int(config_run['cpus'])
+        if multi and ncores not in ('all', 'none') and int(ncores) != cpus:
+            print(f'Warning: run.cpus = {cpus} but expert.ncores = {ncores}, MG uses {ncores} cores')
+    elif not multi:
+        cpus = 1
+    elif ncores in ('all', 'none'):
+        cpus = default_multicore_cpus
+    else:
+        cpus = int(ncores)
+
+    if 'memory' in config_run and str(config_run['memory']).lower() != 'auto':
+        return cpus, int(config_run['memory'])
+
+    if 'metrics' in config_run:
+        metrics_files = [ config_run['metrics'] ]
+    else:
+        metrics_files = glob.glob(f'{output_dir}/merged_*/metrics.json')
+
+    max_rss = get_past_max_rss(metrics_files)
+    if max_rss > 0:
+        # in multi-core mode the max rss is per process, one for each core
+        memory = max_rss * memory_headroom * (cpus if multi else 1) / 1024**2
+        memory = 256 * math.ceil(memory / 256)
+        print(f'- Using request_memory = {memory} MB from previous max rss = {max_rss/1024**2:.0f} MB')
+    else:
+        memory = max(default_memory, 1024 * cpus)
+
+    return cpus, memory
+
+
+# -------
+#  Seeds
+# -------
+
+# MG derives the seeds of each channel from iseed, keep some space between the seeds of different jobs
+seed_stride = 100
+seed_max = 2**29
+
+def get_seed_base(config):
+    seed = config.get('options', {}).get('seed')
+    if seed is None or (isinstance(seed, str) and seed.strip().upper() == 'RANDOM'):
+        return None
+    # 0 means a random seed, as in MG
+    if int(seed) == 0:
+        return None
+    if int(seed) < 0:
+        raise Exception(f'Error: seed = {seed} is not valid, use a positive integer, 0 or RANDOM')
+    return int(seed)
+
+def load_seeds(output_dir, base=None):
+    """
+    State of the seed sequence of output_dir, starting in base (or a random value). It's saved
+    in seeds.json (save_seeds) only when jobs are submitted, so later submissions (e.g. resubmit)
+    continue it and never reuse a seed
+    """
+    path = f'{output_dir}/seeds.json'
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {
+        'base': base if base is not None else random.SystemRandom().randint(1, seed_max),
+        'next': 0,
+        'jobs': {},
+    }
+
+def save_seeds(output_dir, seeds_info):
+    with open(f'{output_dir}/seeds.json', 'w') as f:
+        json.dump(seeds_info, f, indent=2)
+
+def allocate_seeds(seeds_info, n):
+    # next n seeds of the sequence
+    seeds = [ 1 + (seeds_info['base'] - 1 + (seeds_info['next'] + i) * seed_stride) % seed_max for i in range(n) ]
+    seeds_info['next'] += n
+    return seeds
+
+def record_job_seeds(seeds_info, cluster, submitted):
+    # submitted: (run_name, seed) of each job, in the same order as the processes of the cluster
+    for proc, (name, seed) in enumerate(submitted):
+        seeds_info['jobs'][f'{name}_{cluster}_{proc}'] = seed
+
+def record_dag_seeds(seeds_info, dag_file, node_seeds):
+    # the clusters of the DAG nodes are not known when it's submitted: {node: seeds} of each DAG
+    seeds_info.setdefault('dags', {})[dag_file] = node_seeds
+
+
+def get_jobs_queue(name, run_outputs, seeds):
+    # one job for each seed
+    jobs = ''
+    if 'hepmc0' in run_outputs and len(seeds) > 1:
+        outputs_str = ','.join([ o for o in run_outputs if o != 'hepmc0' ])
+
+        jobs += f'run_name = {name}\n'
+        jobs += f'outputs = {outputs_str},hepmc\n'
+        jobs += f'seed = {seeds[0]}\n'
+        jobs += f'queue\n'
+
+        seeds = seeds[1:]
+        jobs += f'run_name = {name}\n'
+        jobs += f'outputs = {outputs_str}\n'
+
+    else:
+        outputs_str = ','.join([ 'hepmc' if o == 'hepmc0' else o for o in run_outputs ])
+
+        jobs += f'run_name = {name}\n'
+        jobs += f'outputs = {outputs_str}\n'
+
+    jobs += 'queue seed from (\n'
+    jobs += '\n'.join(map(str, seeds))
+    jobs += '\n)\n'
+
+    return jobs
+
+def write_shower_desc(output_dir, name, job_replace_dict, run_outputs, shower):
+    # shower jobs over the outputs of the generation jobs, or over the given lhe inputs
+    script_path = f'{output_dir}/run_shower.sh'
+    with open(script_path, 'w') as f:
+        f.write(template_run_shower_script)
+    os.chmod(script_path, 0o755)
+
+    if shower.get('inputs') is not None:
+        jobs = f'queue {shower["jobs"]} input_file from (\n' + '\n'.join(shower['inputs'][name]) + '\n)'
+    else:
+        jobs = f'queue {shower["jobs"]} input_file matching files output_{name}_[0-9]*.tar.gz'
+
+    template = string.Template(template_shower_desc)
+    shower_desc = template.substitute(
+        {
+            'container_image': job_replace_dict['container_image'],
+            'run_name': name,
+            'outputs': ','.join([ o for o in run_outputs if o in ('root', 'lhco') ]),
+            'shared_input_file': job_replace_dict['shared_input_file'],
+            'seeds': ','.join(map(str, shower['seeds'][name])),
+            'shower_jobs': shower['jobs'],
+            'requirements': job_replace_dict['requirements'],
+            'resources': shower['resources'],
+            'jobs': jobs,
+        }
+    )
+
+    job_file = f'shower_{name}.sub'
+    with open(f'{output_dir}/{job_file}', 'w') as f:
+        f.write(shower_desc)
+
+    return job_file
+
+def write_dag(output_dir, run_name, names, job_replace_dict, run_outputs, run_seeds, config_dag, shower=None):
+    """
+    DAG with, for each run name, a generation node with all its jobs, a merge node
+    that runs as soon as they finish and the (optional) post-processing nodes after it.
+    With shower (jobs, seeds, resources), the generation jobs only produce LHE and a shower
+    node runs Pythia8+Delphes over slices of each generation output before the merge.
+    If shower also has inputs (lhe files of each run name) there are no generation nodes
+    """
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+    generation = shower is None or shower.get('inputs') is None
+
+    # Generation
+    if generation:
+        gen_outputs = run_outputs if shower is None else [ 'lhe' ] + [ o for o in run_outputs if o == 'log' ]
+        for name in names:
+            template = string.Template(template_job_desc)
+            job_desc = template.substitute(dict(job_replace_dict, jobs=get_jobs_queue(name, gen_outputs, run_seeds[name])))
+            with open(f'{output_dir}/gen_{name}.sub', 'w') as f:
+                f.write(job_desc)
+
+    # Shower
+    if shower is not None:
+        for name in names:
+            write_shower_desc(output_dir, name, job_replace_dict, run_outputs, shower)
+
+    # Merge
+    shutil.copy(f'{scripts_dir}/merge_mg_pythia_delphes_output.py', output_dir)
+    with open(f'{output_dir}/merge.sub', 'w') as f:
+        f.write(string.Template(template_merge_desc).substitute())
+
+    # Post-processing (conversion, features, ...), run in the merged dir of each run name
+    post_nodes = config_dag.get('post', []) if config_dag else []
+    if post_nodes:
+        script_path = f'{output_dir}/run_dag_post.sh'
+        with open(script_path, 'w') as f:
+            f.write(template_run_dag_post_script)
+        os.chmod(script_path, 0o755)
+
+    for post in post_nodes:
+        script = post['script']
+        if not os.path.exists(script):
+            script = f'{scripts_dir}/{script}'
+        script = os.path.abspath(script)
+
+        arguments = post.get('arguments', '')
+        if isinstance(arguments, list):
+            arguments = ' '.join(arguments)
+
+        template = string.Template(template_post_desc)
+        post_desc = template.substitute(
+            {
+                'post_name': post['name'],
+                'container_image': job_replace_dict['container_image'],
+                'arguments': f'{os.path.basename(script)} {arguments}',
+                'input_files': ','.join([script] + post.get('inputs', [])),
+                'output_files': ','.join(post.get('outputs', [])),
+            }
+        )
+        with open(f'{output_dir}/post_{post["name"]}.sub', 'w') as f:
+            f.write(post_desc)
+
+    dag = ''
+    for name in names:
+        if generation:
+            dag += f'JOB gen_{name} gen_{name}.sub\n'
+        dag += f'JOB merge_{name} merge.sub\n'
+        dag += f'VARS merge_{name} run_name="{name}"\n'
+        if shower is not None:
+            dag += f'JOB shower_{name} shower_{name}.sub\n'
+            if generation:
+                dag += f'PARENT gen_{name} CHILD shower_{name}\n'
+            dag += f'PARENT shower_{name} CHILD merge_{name}\n'
+        else:
+            dag += f'PARENT gen_{name} CHILD merge_{name}\n'
+        for post in post_nodes:
+            dag += f'JOB {post["name"]}_{name} post_{post["name"]}.sub\n'
+            dag += f'VARS {post["name"]}_{name} run_name="{name}"\n'
+            dag += f'PARENT merge_{name} CHILD {post["name"]}_{name}\n'
+        dag += '\n'
+
+    dag_file = f'{run_name}.dag'
+    with open(f'{output_dir}/{dag_file}', 'w') as f:
+        f.write(dag)
+
+    return dag_file
+
+def get_lhe_inputs(config, run_name):
+    # {run name: lhe files}, from a list of files/patterns or a dict of them (one run name for each key)
+    lhe_inputs = config['lhe_inputs']
+    if not isinstance(lhe_inputs, dict):
+        lhe_inputs = { None: lhe_inputs }
+
+    inputs = {}
+    for key, patterns in lhe_inputs.items():
+        if isinstance(patterns, str):
+            patterns = [ patterns ]
+
+        files = []
+        for pattern in patterns:
+            files.extend(sorted(glob.glob(os.path.expanduser(pattern))))
+        if not files:
+            raise Exception(f'Error in lhe_inputs: no files found for {", ".join(patterns)}')
+
+        for f in files:
+            if not f.endswith(('.lhe', '.lhe.gz', '.tar.gz')):
+                raise Exception(f'Error in lhe_inputs: {f} is not a lhe, lhe.gz or job output tar.gz file')
+
+        inputs[run_name if key is None else f'{run_name}_{key}'] = [ os.path.abspath(f) for f in files ]
+
+    return inputs
+
+def count_lhe_events(path):
+    # number of events of a lhe input, the lhe file of a job output tarball is the one used by the shower jobs
+    if path.endswith('.tar.gz'):
+        with tarfile.open(path, 'r:gz') as tar:
+            for member in tar:
+                if member.name.endswith('.lhe.gz') and 'before_decay' not in member.name:
+                    with gzip.open(tar.extractfile(member)) as f:
+                        return sum(b'<event>' in line for line in f)
+        return 0
+
+    with (gzip.open(path) if path.endswith('.gz') else open(path, 'rb')) as f:
+        return sum(b'<event>' in line for line in f)
+
+def submit_lhe_inputs(config, output_dir, container_image_path, run_outputs, shower_jobs, args):
+    """
+    Pythia8+Delphes over existing lhe files (lhe.gz files or job output tarballs with them),
+    skipping the MG generation. The jobs, outputs and merge are the same as for the shower jobs
+    """
+    run_name = config['run']['name']
+    config_cards = config['cards']
+
+    inputs = get_lhe_inputs(config, run_name)
+    for name, files in inputs.items():
+        print(f'- {name}: {len(files)} lhe inputs')
+
+    shared_input_file = f'inputs_{run_name}.tar.gz'
+    print(f'- Compressing shared input files here: {output_dir}/{shared_input_file}')
+    write_run_tarball(f'{output_dir}/{shared_input_file}', {
+        'cards/pythia8_card.dat': read_file(config_cards['pythia']),
+        'cards/delphes_card.dat': read_file(config_cards['delphes']),
+        'job_metrics.py': template_job_metrics_script.encode(),
+        'package_outputs.py': template_package_outputs_script.encode(),
+    })
+
+    job_replace_dict = {
+        'container_image': container_image_path,
+        'shared_input_file': shared_input_file,
+        'requirements': f'requirements = {config["run"]["requirements"]}' if 'requirements' in config['run'] else '',
+    }
+
+    njobs = shower_jobs or 1
+    _, request_memory = get_job_resources(config, output_dir)
+
+    seeds_info = load_seeds(output_dir, get_seed_base(config))
+    shower = {
+        'jobs': njobs,
+        'seeds': { name: allocate_seeds(seeds_info, len(files) * njobs) for name, files in inputs.items() },
+        'resources': f'request_cpus = 1\nrequest_memory = {request_memory}',
+        'inputs': inputs,
+    }
+
+    # events of each job for the status command: run.nevents of each input if given, or counted in the inputs
+    if not args.dry_run:
+        runs_info = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for name, files in inputs.items():
+                if 'nevents' in config['run']:
+                    nevents = int(config['run']['nevents']) * len(files)
+                else:
+                    nevents = sum(pool.map(count_lhe_events, files))
+                    print(f'- {name}: {nevents} events')
+                runs_info[f'shower_{name}'] = { 'nevents': nevents // (len(files) * njobs), 'njobs': len(files) * njobs, 'outputs': run_outputs, 'shower': True }
+        save_runs_info(output_dir, runs_info)
+
+    if args.dag:
+        dag_file = write_dag(output_dir, run_name, list(inputs), job_replace_dict, run_outputs, None, config.get('dag'), shower)
+
+        print(f'- Saving DAG description in {output_dir}/{dag_file}')
+        if not args.dry_run:
+            os.chdir(output_dir)
+            if os.system(f'condor_submit_dag {dag_file}') == 0:
+                record_dag_seeds(seeds_info, dag_file, { f'shower_{name}': seeds for name, seeds in shower['seeds'].items() })
+                save_seeds(output_dir, seeds_info)
+        return
+
+    os.chdir(output_dir)
+    for name in inputs:
+        job_file = write_shower_desc(output_dir, name, job_replace_dict, run_outputs, shower)
+
+        print(f'- Saving job submission description in {output_dir}/{job_file}')
+        if not args.dry_run:
+            cluster = condor_submit(job_file)
+            if cluster is not None:
+                record_job_seeds(seeds_info, cluster, [ (name, seed) for seed in shower['seeds'][name] ])
+            save_seeds(output_dir, seeds_info)
+
+
+# ----------------
+#  Jobs status
+# ----------------
+
+job_log_pattern = re.compile(r'job_(.+)_(\d+)_(\d+)\.log')
+# shower jobs (run.shower_jobs, lhe_inputs) are followed as the run shower_<run_name>
+shower_log_pattern = re.compile(r'shower_(.+)_(\d+)_(\d+)\.log')
+
+def load_runs_info(output_dir):
+    path = f'{output_dir}/runs.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_runs_info(output_dir, runs_info):
+    with open(f'{output_dir}/runs.json', 'w') as f:
+        json.dump(runs_info, f, indent=2)
+
+def parse_log_time(date_str, time_str):
+    try:
+        return datetime.datetime.strptime(f'{date_str} {time_str}', '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        # old format without year (MM/DD)
+        t = datetime.datetime.strptime(f'{date_str} {time_str}', '%m/%d %H:%M:%S')
+        return t.replace(year=datetime.datetime.now().year).timestamp()
+
+def update_job_state(job, event):
+    tokens = event[0].split()
+    code = int(tokens[0])
+    t = parse_log_time(tokens[2], tokens[3])
+
+    if code == 0: # submitted
+        job['state'] = 'idle'
+    elif code == 1: # executing
+        job['state'] = 'running'
+        job['start'] = t
+    elif code in (4, 13): # evicted, released
+        job['state'] = 'idle'
+    elif code == 12: # held
+        job['state'] = 'held'
+    elif code in (2, 9): # executable error, aborted
+        job['state'] = 'failed'
+        job['end'] = t
+    elif code == 5: # terminated
+        match = re.search(r'return value (\d+)', ''.join(event))
+        job['state'] = 'done' if match and int(match.group(1)) == 0 else 'failed'
+        job['end'] = t
+
+def read_job_log(path, job):
+    # read complete events (ending with '...') from the last saved offset
+    with open(path, 'rb') as f:
+        f.seek(job['offset'])
+        offset = job['offset']
+        event = []
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            event.append(line.decode(errors='replace'))
+            if line.strip() == b'...':
+                if event[0][:3].isdigit():
+                    update_job_state(job, event)
+                job['offset'] = offset
+                event = []
+
+def get_jobs_status(output_dir):
+    """
+    State of each job from the condor user logs in output_dir. Logs are read incrementally,
+    the offsets and states are saved in status.json (replaced atomically, as it's written by the status
+    command and the orchestrator at the same time)
+    """
+    status_path = f'{output_dir}/status.json'
+    try:
+        with open(status_path) as f:
+            jobs = json.load(f)
+    except FileNotFoundError:
+        jobs = {}
+    except ValueError:
+        # truncated by a previous version, the logs are read again from the start
+        jobs = {}
+
+    current_logs = set()
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            match = job_log_pattern.fullmatch(entry.name) or shower_log_pattern.fullmatch(entry.name)
+            if not match:
+                continue
+            current_logs.add(entry.name)
+
+            run_name = match.group(1) if match.re is job_log_pattern else f'shower_{match.group(1)}'
+            job = jobs.setdefault(entry.name, { 'run_name': run_name, 'offset': 0, 'state': 'idle', 'start': None, 'end': None })
+            if entry.stat().st_size > job['offset']:
+                read_job_log(entry.path, job)
+
+    # logs removed (e.g. run dirs rebuilt in incremental mode)
+    jobs = { name: job for name, job in jobs.items() if name in current_logs }
+
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, prefix='.status.json.', delete=False) as f:
+        json.dump(jobs, f)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, status_path)
+
+    return jobs
+
+def format_duration(seconds):
+    hours, seconds = divmod(int(seconds), 3600)
+    return f'{hours}h{seconds // 60:02d}m'
+
+def main_status(argv):
+
+    parser = argparse.ArgumentParser(description='run_mg_pythia_delphes.py status')
+    parser.add_argument('output', help='Output directory')
+    args = parser.parse_args(argv)
+
+    output_dir = os.path.abspath(args.output)
+
+    runs_info = load_runs_info(output_dir)
+    jobs = get_jobs_status(output_dir)
+
+    states = ('idle', 'running', 'held', 'done', 'failed')
+
+    counts = {}
+    for name, info in runs_info.items():
+        counts[name] = dict.fromkeys(states, 0)
+    for job in jobs.values():
+        counts.setdefault(job['run_name'], dict.fromkeys(states, 0))[job['state']] += 1
+
+    # jobs without log yet are counted as idle
+    for name, info in runs_info.items():
+        counts[name]['idle'] += max(0, info['njobs'] - sum(counts[name].values()))
+
+    width = max([ len(name) for name in counts ] + [ 8 ])
+    print(f'{"run_name":{width}}  ' + '  '.join(f'{state:>7}' for state in states) + f'  {"events":>10}')
+
+    total = dict.fromkeys(states, 0)
+    total_events = 0
+    remaining_events = 0
+    for name in sorted(counts):
+        nevents = runs_info.get(name, {}).get('nevents', 0)
+        events = counts[name]['done'] * nevents
+        total_events += events
+        remaining_events += (counts[name]['idle'] + counts[name]['running'] + counts[name]['held']) * nevents
+        for state in states:
+            total[state] += counts[name][state]
+        print(f'{name:{width}}  ' + '  '.join(f'{counts[name][state]:>7}' for state in states) + f'  {events:>10}')
+
+    print(f'{"total":{width}}  ' + '  '.join(f'{total[state]:>7}' for state in states) + f'  {total_events:>10}')
+
+    starts = [ job['start'] for job in jobs.values() if job['start'] is not None ]
+    if starts and total_events > 0:
+        elapsed = time.time() - min(starts)
+        rate = total_events / elapsed * 3600
+        print(f'\nThroughput: {rate:.0f} events/hour')
+        if remaining_events > 0:
+            print(f'ETA: {format_duration(remaining_events / rate * 3600)} ({remaining_events} events remaining)')
+        else:
+            print('All jobs finished')
+
+
+# ---------------
+#  Resubmission
+# ---------------
+
+output_file_pattern = re.compile(r'output_(.+)_(\d+)_(\d+)\.tar\.gz')
+
+def get_job_header(output_dir):
+    # submission description (without the queue statements) of a previous submission
+    for path in sorted(glob.glob(f'{output_dir}/*.sub')):
+        with open(path) as f:
+            job_desc = f.read()
+        if job_desc.startswith('# MG+Pythia+Delphes - job submission file'):
+            return job_desc.split('\nrun_name = ')[0]
+    return None
+
+def condor_submit(job_file):
+    # submit and return the cluster id
+    try:
+        result = subprocess.run(['condor_submit', job_file], capture_output=True, text=True)
+    except FileNotFoundError:
+        print('Error: condor_submit not found')
+        return None
+
+    print(result.stdout, end='')
+    print(result.stderr, end='', file=sys.stderr)
+
+    match = re.search(r'submitted to cluster (\d+)', result.stdout)
+    return int(match.group(1)) if match else None
+
+def main_resubmit(argv):
+
+    parser = argparse.ArgumentParser(description='run_mg_pythia_delphes.py resubmit')
+    parser.add_argument('output', help='Output directory')
+    parser.add_argument('--dry-run', action='store_true', help='Prepare submission file but don\'t submit jobs')
+    args = parser.parse_args(argv)
+
+    output_dir = os.path.abspath(args.output)
+
+    runs_info = load_runs_info(output_dir)
+    jobs = get_jobs_status(output_dir)
+
+    job_header = get_job_header(output_dir)
+    if not runs_info or job_header is None:
+        print(f'Error: no previous condor submission found in {output_dir}')
+        sys.exit(1)
+
+    # the seed is passed as last argument
+    if '$(seed)' not in job_header:
+        job_header = re.sub(r'(arguments\s*=.*)', r'\1 $(seed)', job_header, count=1)
+
+    outputs = set(os.listdir(output_dir))
+
+    ok_jobs = {}
+    active_jobs = {}
+    failed_outputs = []
+    for log_name, job in jobs.items():
+        match = job_log_pattern.fullmatch(log_name)
+        if not match:
+            continue
+        run_name, cluster, proc = match.groups()
+        output_file = f'output_{run_name}_{cluster}_{proc}.tar.gz'
+        if job['state'] == 'done' and output_file in outputs:
+            ok_jobs.setdefault(run_name, set()).add(output_file)
+        elif job['state'] in ('idle', 'running', 'held'):
+            active_jobs[run_name] = active_jobs.get(run_name, 0) + 1
+        elif output_file in outputs:
+            failed_outputs.append(output_file)
+
+    # outputs without log are considered ok
+    for output_file in outputs:
+        match = output_file_pattern.fullmatch(output_file)
+        if match and output_file not in failed_outputs:
+            ok_jobs.setdefault(match.group(1), set()).add(output_file)
+
+    jobs_str = ''
+    nmissing = 0
+    submitted = []
+    seeds_info = load_seeds(output_dir)
+    for name, info in sorted(runs_info.items()):
+        if info.get('shower'):
+            print(f'- {name}: shower jobs are not resubmitted, rerun the shower node with the rescue DAG')
+            continue
+        nok = len(ok_jobs.get(name, []))
+        nactive = active_jobs.get(name, 0)
+        missing = info['njobs'] - nok - nactive
+        print(f'- {name}: {nok} ok, {nactive} idle/running/held, {max(0, missing)} to resubmit')
+        if missing <= 0:
+            continue
+
+        nmissing += missing
+        seeds = allocate_seeds(seeds_info, missing)
+
+        # hepmc0: keep the hepmc output only if none of the jobs of this run finished
+        run_outputs = info.get('outputs', ['lhe', 'lhco', 'log'])
+        if nok > 0:
+            run_outputs = [ o for o in run_outputs if o != 'hepmc0' ]
+
+        jobs_str += get_jobs_queue(name, run_outputs, seeds)
+        submitted += [ (name, seed) for seed in seeds ]
+
+    # keep the debug outputs of failed jobs away from the merge
+    if failed_outputs and not args.dry_run:
+        mkdir(f'{output_dir}/failed')
+        for output_file in failed_outputs:
+            os.rename(f'{output_dir}/{output_file}', f'{output_dir}/failed/{output_file}')
+        print(f'- Moved {len(failed_outputs)} outputs of failed jobs to {output_dir}/failed')
+
+    if nmissing == 0:
+        print('- Nothing to resubmit')
+        return
+
+    n = 1
+    while os.path.exists(f'{output_dir}/resubmit_{n}.sub'):
+        n += 1
+    job_file = f'resubmit_{n}.sub'
+
+    print(f'- Saving job submission description for {nmissing} jobs in {output_dir}/{job_file}')
+    with open(f'{output_dir}/{job_file}', 'w') as f:
+        f.write(job_header + '\n' + jobs_str + '\n')
+
+    if not args.dry_run:
+        os.chdir(output_dir)
+        cluster = condor_submit(job_file)
+        if cluster is not None:
+            record_job_seeds(seeds_info, cluster, submitted)
+        save_seeds(output_dir, seeds_info)
+
+
+class ContainerSession:
+    """
+    Long-lived container running a single shell. The mg-pythia-delphes
+    environment is prepared once and then each command is fed through stdin
+    """
+
+    done_marker = '__mg_pythia_delphes_done__'
+
+    def __init__(self, run_mode, image, bind_dir, bind_path='/local'):
+        if run_mode == 'local-docker':
+            self.cmd = ['docker', 'run', '--rm', '-i', '-v', f'{bind_dir}:{bind_path}', image, '/bin/bash']
+        elif run_mode == 'local-apptainer':
+            self.cmd = ['apptainer', 'exec', '--bind', f'{bind_dir}:{bind_path}', image, '/bin/bash', '-l']
+        else:
+            raise ValueError(f'No container session available for run_mode = {run_mode}')
+        self.proc = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(kill=exc_type is not None)
+
+    def start(self):
+        print(' '.join(self.cmd))
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+
+        # MG_DIR is not exported by the setup script, export it so the run scripts don't source it again
+        sc = self.run('{ [ -n "${MG_DIR+x}" ] || source /setup_mg_pythia_delphes.sh ; } && export MG_DIR')
+        if sc != 0:
+            self.close(kill=True)
+            raise RuntimeError('Error preparing the mg-pythia-delphes environment in the container')
+
+    def run(self, cmd):
+        # commands must not read from stdin, it is used to feed the session
+        self.proc.stdin.write(f'{{ {cmd} ; }} < /dev/null ; echo "{self.done_marker} $?"\n')
+        self.proc.stdin.flush()
+
+        for line in self.proc.stdout:
+            if self.done_marker in line:
+                output, status = line.split(self.done_marker)
+                if output:
+                    print(output)
+                return int(status)
+            sys.stdout.write(line)
+
+        raise RuntimeError('Container session exited unexpectedly')
+
+    def close(self, kill=False):
+        if self.proc is None:
+            return
+
+        if kill:
+            self.proc.kill()
+        else:
+            try:
+                self.proc.stdin.write('exit\n')
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        self.proc.wait()
+        self.proc = None
+
+
+def get_local_cmd(output_dir, name, run_dir, seed):
+    cmd = f'cd /local/{os.path.relpath(run_dir, output_dir)} ; '
+    cmd += f'./run_mg_pythia_delphes.sh {name} run_{name} {seed}'
+    return cmd
+
+def run_local(run_mode, container_image_path, output_dir, run_dirs, run_seeds, dry_run=False):
+
+    # one container for all the run dirs, output_dir is mounted in /local
+    work_queue = queue.Queue()
+    for name, run_dir in run_dirs.items():
+        work_queue.put((name, get_local_cmd(output_dir, name, run_dir, run_seeds[name][0])))
+
+    if dry_run:
+        while not work_queue.empty():
+            name, cmd = work_queue.get()
+            print(cmd)
+        return
+
+    failed = []
+    with ContainerSession(run_mode, container_image_path, output_dir) as session:
+        while True:
+            try:
+                name, cmd = work_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            print(f'- Running {name} in container session')
+            print(cmd)
+            if session.run(cmd) != 0:
+                failed.append(name)
+
+    if failed:
+        print(f'Error: the following runs failed: {", ".join(failed)}')
+
+    return failed
+
+
+# --------------
+#  Orchestration
+# --------------
+
+class Executor(abc.ABC):
+    """
+    Backend used by the orchestrator: submit the jobs of a run dir and wait for them.
+    merge_outputs tells if the jobs produce output tarballs that can be merged
+    """
+
+    merge_outputs = True
+
+    @abc.abstractmethod
+    async def submit(self, name, seeds):
+        # returns a handle to wait for the jobs
+        pass
+
+    @abc.abstractmethod
+    async def wait(self, handle):
+        # returns the number of failed jobs
+        pass
+
+    async def close(self):
+        pass
+
+
+class CondorExecutor(Executor):
+
+    def __init__(self, output_dir, job_replace_dict, run_outputs, seeds_info, poll_interval=30, timeout=None):
+        self.output_dir = output_dir
+        self.job_replace_dict = job_replace_dict
+        self.run_outputs = run_outputs
+        self.seeds_info = seeds_info
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.waiters = {}
+        self.poller = None
+
+    async def submit(self, name, seeds):
+        job_file = f'gen_{name}.sub'
+        template = string.Template(template_job_desc)
+        with open(f'{self.output_dir}/{job_file}', 'w') as f:
+            f.write(template.substitute(dict(self.job_replace_dict, jobs=get_jobs_queue(name, self.run_outputs, seeds))))
+
+        proc = await asyncio.create_subprocess_exec('condor_submit', job_file, cwd=self.output_dir,
+                                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        print(stdout.decode(), end='')
+        print(stderr.decode(), end='', file=sys.stderr)
+
+        match = re.search(r'submitted to cluster (\d+)', stdout.decode())
+        if not match:
+            raise RuntimeError(f'Error submitting jobs of {name}')
+
+        cluster = int(match.group(1))
+        record_job_seeds(self.seeds_info, cluster, [ (name, seed) for seed in seeds ])
+        save_seeds(self.output_dir, self.seeds_info)
+        return (name, cluster, len(seeds))
+
+    async def wait(self, handle):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[handle] = future
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.create_task(self.poll())
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.waiters.pop(handle, None)
+            raise RuntimeError(f'jobs of cluster {handle[1]} not finished after {self.timeout} s')
+
+    async def poll(self):
+        # a single reader of the job logs for all the waiting runs. Errors reading the logs are
+        # passed to the waiting runs, so they do not wait forever
+        try:
+            while self.waiters:
+                await asyncio.sleep(self.poll_interval)
+                jobs = await asyncio.to_thread(get_jobs_status, self.output_dir)
+                self.update_waiters(jobs)
+        except Exception as e:
+            for future in self.waiters.values():
+                if not future.done():
+                    future.set_exception(e)
+            self.waiters.clear()
+
+    def update_waiters(self, jobs):
+        # held jobs count as failed, they do not finish without the user releasing them
+        finished = {}
+        for log_name, job in jobs.items():
+            match = job_log_pattern.fullmatch(log_name)
+            if not match or job['state'] not in ('done', 'failed', 'held'):
+                continue
+            name, cluster, proc = match.groups()
+            counts = finished.setdefault((name, int(cluster)), [0, 0])
+            counts[job['state'] != 'done'] += 1
+
+        for handle, future in list(self.waiters.items()):
+            name, cluster, njobs = handle
+            done, failed = finished.get((name, cluster), (0, 0))
+            if done + failed >= njobs:
+                del self.waiters[handle]
+                if not future.done():
+                    future.set_result(failed)
+
+
+class LocalExecutor(Executor):
+    """
+    Runs in the local container session, one run dir at a time. The outputs stay in the run dirs
+    """
+
+    merge_outputs = False
+
+    def __init__(self, run_mode, image, output_dir, run_dirs):
+        self.run_mode = run_mode
+        self.image = image
+        self.output_dir = output_dir
+        self.run_dirs = run_dirs
+        self.session = None
+        self.lock = threading.Lock()
+
+    def run(self, name, seed):
+        with self.lock:
+            if self.session is None:
+                self.session = ContainerSession(self.run_mode, self.image, self.output_dir)
+                self.session.start()
+            print(f'- Running {name} in container session')
+            return self.session.run(get_local_cmd(self.output_dir, name, self.run_dirs[name], seed))
+
+    async def submit(self, name, seeds):
+        return asyncio.create_task(asyncio.to_thread(self.run, name, seeds[0]))
+
+    async def wait(self, handle):
+        return 0 if await handle == 0 else 1
+
+    async def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+class FakeExecutor(Executor):
+    """
+    Fake scheduler to test the orchestration without condor or containers. Each job sleeps
+    for a random time and then writes a condor-like log and an output tarball with its metrics
+    """
+
+    def __init__(self, output_dir, max_time=2., fail_rate=0.):
+        self.output_dir = output_dir
+        self.max_time = max_time
+        self.fail_rate = fail_rate
+        self.next_cluster = 1
+
+    def log_event(self, name, cluster, proc, code, text):
+        t = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(f'{self.output_dir}/job_{name}_{cluster}_{proc}.log', 'a') as f:
+            f.write(f'{code:03d} ({cluster:03d}.{proc:03d}.000) {t} {text}\n...\n')
+
+    def write_output(self, name, cluster, proc, seed, wall_time):
+        output_name = f'output_{name}_{cluster}_{proc}'
+        metrics = {
+            'run_name': name, 'output_name': output_name, 'seed': seed, 'hostname': 'fake',
+            'stages': { 'madgraph': { 'wall_time': wall_time, 'cpu_time': wall_time, 'max_rss': 0, 'bytes_written': 0 } },
+        }
+        write_run_tarball(f'{self.output_dir}/{output_name}.tar.gz',
+                          { f'{output_name}_metrics.json': json.dumps(metrics, indent=2).encode() })
+
+    async def run_job(self, name, cluster, proc, seed):
+        self.log_event(name, cluster, proc, 1, 'Job executing on host: <fake>')
+        wall_time = random.uniform(0, self.max_time)
+        await asyncio.sleep(wall_time)
+
+        sc = 1 if random.random() < self.fail_rate else 0
+        if sc == 0:
+            await asyncio.to_thread(self.write_output, name, cluster, proc, seed, wall_time)
+        self.log_event(name, cluster, proc, 5, f'Job terminated.\n\t(1) Normal termination (return value {sc})')
+        return sc
+
+    async def submit(self, name, seeds):
+        cluster = self.next_cluster
+        self.next_cluster += 1
+        for proc in range(len(seeds)):
+            self.log_event(name, cluster, proc, 0, 'Job submitted from host: <fake>')
+        return asyncio.gather(*(self.run_job(name, cluster, proc, seed) for proc, seed in enumerate(seeds)))
+
+    async def wait(self, handle):
+        return sum(sc != 0 for sc in await handle)
+
+
+async def merge_run(output_dir, name):
+    # -r: the glob also matches the outputs of runs named {name}_<suffix>
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(f'{output_dir}/merge_{name}.out', 'w') as out:
+        proc = await asyncio.create_subprocess_exec(sys.executable, f'{scripts_dir}/merge_mg_pythia_delphes_output.py',
+                                                    '-i', f'output_{name}_*.tar.gz', '-r', name, '-o', f'merged_{name}',
+                                                    cwd=output_dir, stdout=out, stderr=subprocess.STDOUT)
+        return await proc.wait()
+
+async def orchestrate_runs(executor, output_dir, names, run_seeds, stage=None, max_merges=None):
+    """
+    Each run dir goes through stage -> submit -> wait -> merge on its own, so the first
+    jobs are submitted while the other inputs are still being packed and each run is
+    merged as soon as its jobs finish
+    """
+    merge_semaphore = asyncio.Semaphore(max_merges or os.cpu_count() or 1)
+
+    async def process(name):
+        if stage is not None:
+            await asyncio.to_thread(stage, name)
+
+        handle = await executor.submit(name, run_seeds[name])
+        print(f'- {name}: submitted {len(run_seeds[name])} jobs')
+
+        failed = await executor.wait(handle)
+        print(f'- {name}: jobs finished ({failed} failed)')
+
+        if failed or not executor.merge_outputs:
+            return failed == 0
+
+        async with merge_semaphore:
+            sc = await merge_run(output_dir, name)
+        print(f'- {name}: merged in {output_dir}/merged_{name}' if sc == 0 else f'- {name}: merge failed, see {output_dir}/merge_{name}.out')
+        return sc == 0
+
+    try:
+        results = await asyncio.gather(*(process(name) for name in names), return_exceptions=True)
+    finally:
+        await executor.close()
+
+    failed = []
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            print(f'Error: {name}: {result}')
+        if result is not True:
+            failed.append(name)
+
+    if failed:
+        print(f'Error: the following runs failed: {", ".join(failed)}')
+
+    return failed
+
+
 def main():
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        return main_status(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'resubmit':
+        return main_resubmit(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='run_mg_pythia_delphes.py')
 
     # Main required arguments
     parser.add_argument('-c', '--config', required=True, help='Configuration file')
     parser.add_argument('-o', '--output', required=True, help='Output directory')
     parser.add_argument('-f', '--force', help='Force overwrite of output files', action='store_true')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Reuse existing output dir, only rebuild and run again the run dirs whose inputs changed')
 
     # Run options
     parser.add_argument('--run_mode', default=None, choices=['local-docker', 'local-apptainer', 'condor', 'jupiter'], help='Run mode')
     parser.add_argument('--dry-run', action='store_true', help='Prepare directory and files but don\'t run or submit jobs')
+    parser.add_argument('--dag', action='store_true', help='Submit a DAG with generation, merge and post-processing nodes for each run (condor only)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of parallel workers used to prepare the input files')
+    parser.add_argument('--orchestrate', action='store_true', help='Pack, submit, wait and merge each run dir independently, overlapping the runs')
+    parser.add_argument('--fake-scheduler', action='store_true', help='With --orchestrate, use a fake scheduler instead of condor/containers (for testing)')
+    parser.add_argument('--timeout', type=float, default=None, help='With --orchestrate and condor, hours to wait for the jobs of each run before giving up on it')
 
     args = parser.parse_args()
 
@@ -400,6 +2228,33 @@ def main():
     run_njobs   = config_run['njobs'] if 'njobs' in config_run else 1
     run_outputs = config_run['outputs'] if 'outputs' in config_run else ['lhe', 'lhco', 'log']
 
+    # Pythia8+Delphes in separate jobs, each one over a slice of the events of a generation job
+    shower_jobs = config_run.get('shower_jobs', 0)
+    if 'lhe_inputs' in config:
+        if run_mode not in ('condor', 'jupiter') or args.orchestrate:
+            print('Error: lhe_inputs is only available with condor (not with --orchestrate)')
+            sys.exit(1)
+        if 'cards' not in config or 'pythia' not in config['cards'] or 'delphes' not in config['cards']:
+            print('Error: lhe_inputs needs the pythia and delphes cards')
+            sys.exit(1)
+    elif shower_jobs:
+        if run_mode not in ('condor', 'jupiter') or not args.dag or args.orchestrate:
+            print('Error: run.shower_jobs is only available with condor and --dag (not with --orchestrate)')
+            sys.exit(1)
+        if 'cards' not in config or 'pythia' not in config['cards'] or 'delphes' not in config['cards']:
+            print('Error: run.shower_jobs needs the pythia and delphes cards')
+            sys.exit(1)
+
+    # Pythia8+Delphes in parallel processes inside each job
+    parallel_shower = config.get('expert', {}).get('parallel_shower', False)
+    if parallel_shower:
+        if run_mode not in ('condor', 'jupiter') or shower_jobs:
+            print('Error: expert.parallel_shower is only available with condor and without run.shower_jobs')
+            sys.exit(1)
+        if 'cards' not in config or 'pythia' not in config['cards'] or 'delphes' not in config['cards']:
+            print('Error: expert.parallel_shower needs the pythia and delphes cards')
+            sys.exit(1)
+
 
     # Create working directory
     output = args.output
@@ -410,7 +2265,9 @@ def main():
 
     print(f'- Using working/output dir: {output_dir}')
     if os.path.exists(output_dir):
-        if args.force:
+        if args.incremental:
+            print('Output dir already exists. Only run dirs with changed inputs will be updated.')
+        elif args.force:
             print('Output dir already exists. Removing it.')
             shutil.rmtree(output_dir)
             mkdir(output_dir)
@@ -421,8 +2278,15 @@ def main():
         mkdir(output_dir)
 
 
+    # Pythia8+Delphes over existing lhe files, without MG generation
+    if 'lhe_inputs' in config:
+        return submit_lhe_inputs(config, output_dir, container_image_path, run_outputs, shower_jobs, args)
+
+
     # Inputs
+    # the files of each run dir are kept in memory ({path: content}) until they are staged
     run_dirs = {}
+    run_files = {}
 
     #  Custom input
     if 'input_files' in config or 'input_dir' in config or 'input_dirs' in config:
@@ -435,31 +2299,29 @@ def main():
                 run_dir_model = f'{output_dir}/run_{model_name}'
                 run_dirs[model_name] = run_dir_model
 
-                shutil.copytree(input_dir, run_dir_model)
+                run_files[model_name] = read_dir(input_dir)
 
         elif 'input_dir' in config:
 
             run_dir = f'{output_dir}/run_{run_name}'
             run_dirs[run_name] = run_dir
 
-            shutil.copytree(config['input_dir'], run_dir)
+            run_files[run_name] = read_dir(config['input_dir'])
 
         else:
 
             run_dir = f'{output_dir}/run_{run_name}'
             run_dirs[run_name] = run_dir
 
-            mkdir(run_dir)
-            for f in config['input_files']:
-                shutil.copy(f, run_dir)
+            run_files[run_name] = { os.path.basename(f): read_file(f) for f in config['input_files'] }
 
 
         for name, run_dir in run_dirs.items():
 
-            if not os.path.exists(f'{run_dir}/run.mg5'):
+            if 'run.mg5' not in run_files[name]:
                 raise Exception('Error in input files: run.mg5 not found in input dir')
 
-            run_mg5_str = open(f'{run_dir}/run.mg5').read()
+            run_mg5_str = run_files[name]['run.mg5'].decode()
 
             options = [
                 f'set run_tag = {name}',
@@ -478,8 +2340,7 @@ def main():
             run_mg5_str += options_str
             run_mg5_str += '\n\ndone\n'
 
-            with open(f'{run_dir}/run.mg5', 'w') as f:
-                f.write(run_mg5_str)
+            run_files[name]['run.mg5'] = run_mg5_str.encode()
 
 
     else:
@@ -501,39 +2362,59 @@ def main():
                 run_dir_model = f'{output_dir}/run_{model_name}'
 
                 run_dirs[model_name] = run_dir_model
+                run_files[model_name] = {
+                    'cards/param_card.dat': read_file(card),
+                }
 
-                mkdir(run_dir_model)
-                mkdir(f'{run_dir_model}/cards')
+        elif 'param_scan' in config_cards:
 
-                shutil.copyfile(card, f'{run_dir_model}/cards/param_card.dat')
+            print(f'- Preparing param cards for scan from {config_cards["param_scan"]["base"]}')
+            scan = get_scan_param_cards(config_cards['param_scan'])
+
+            scan_table = {}
+            for name, (card, values) in scan.items():
+                model_name = f'{run_name}_{name}'
+                run_dir_model = f'{output_dir}/run_{model_name}'
+
+                run_dirs[model_name] = run_dir_model
+                run_files[model_name] = {
+                    'cards/param_card.dat': card,
+                }
+                scan_table[model_name] = values
+
+            print(f'- Saving {len(scan_table)} scan points in {output_dir}/scan_{run_name}.json')
+            with open(f'{output_dir}/scan_{run_name}.json', 'w') as f:
+                json.dump(scan_table, f, indent=2)
 
         else:
             run_dir = f'{output_dir}/run_{run_name}'
             run_dirs[run_name] = run_dir
-
-            #if not os.path.exists(inputs_dir):
-            mkdir(run_dir)
-            mkdir(f'{run_dir}/cards')
+            run_files[run_name] = {}
 
             if 'param' in config_cards:
-                shutil.copyfile(config_cards["param"], f'{run_dir}/cards/param_card.dat')
+                run_files[run_name]['cards/param_card.dat'] = read_file(config_cards['param'])
 
-        ## Other cards
+        ## Other cards (the same content is shared by all run dirs)
         run_madspin = 'madspin' in config_cards
         run_pythia  = 'pythia' in config_cards
         run_delphes = 'delphes' in config_cards
 
-        for name, run_dir in run_dirs.items():
-            shutil.copyfile(config_cards['run'], f'{run_dir}/cards/run_card.dat')
-            if run_madspin:
-                shutil.copyfile(config_cards["madspin"], f'{run_dir}/cards/madspin_card.dat')
-            if run_pythia:
-                shutil.copyfile(config_cards["pythia"],  f'{run_dir}/cards/pythia8_card.dat')
-            if run_delphes:
-                shutil.copyfile(config_cards["delphes"], f'{run_dir}/cards/delphes_card.dat')
+        common_files = {
+            'cards/run_card.dat': read_file(config_cards['run']),
+        }
+        if run_madspin:
+            common_files['cards/madspin_card.dat'] = read_file(config_cards['madspin'])
+        if run_pythia:
+            common_files['cards/pythia8_card.dat'] = read_file(config_cards['pythia'])
+        if run_delphes:
+            common_files['cards/delphes_card.dat'] = read_file(config_cards['delphes'])
+
+        # pythia/delphes cards are still shipped for the shower jobs, but MG stops after generation
+        if shower_jobs or parallel_shower:
+            run_pythia = run_delphes = False
 
         cards_str = 'cards/run_card.dat\n'
-        if 'param' in config_cards:
+        if 'param' in config_cards or 'param_scan' in config_cards:
             cards_str += 'cards/param_card.dat\n'
         if run_madspin:
             cards_str += 'cards/madspin_card.dat\n'
@@ -559,7 +2440,7 @@ def main():
 
         if 'set run_card custom_fcts /local/user_cuts.f' in config_options:
             # copy user cut module to each run dir
-            shutil.copyfile('user_cuts.f', f'{run_dir}/user_cuts.f')
+            common_files['user_cuts.f'] = read_file('user_cuts.f')
 
         for name, run_dir in run_dirs.items():
 
@@ -583,19 +2464,91 @@ def main():
                 }
             )
 
-            with open(f'{run_dir}/run.mg5', 'w') as f:
-                f.write(run_mg_str)
+            run_files[name].update(common_files)
+            run_files[name]['run.mg5'] = run_mg_str.encode()
+
+    # the shower of shower_jobs and parallel_shower (DelphesPythia8 with the pythia8 card) doesn't do the
+    # matching/merging of the MG Pythia8 interface, the samples would be wrong
+    if shower_jobs or parallel_shower:
+        for name, files in run_files.items():
+            matching = get_matching_options(files)
+            if matching:
+                print(f'Error: run.shower_jobs and expert.parallel_shower do not support matching/merging, enabled in {name} by '
+                      + ', '.join(f'{k} = {v}' for k, v in matching.items()))
+                sys.exit(1)
+
 
 
+    # Helpers to measure the job stages and package the outputs
+    job_metrics_script = template_job_metrics_script.encode()
+    package_outputs_script = template_package_outputs_script.encode()
+    for files in run_files.values():
+        files['job_metrics.py'] = job_metrics_script
+        files['package_outputs.py'] = package_outputs_script
+
+    # Fingerprint of the inputs of each run dir
+    fingerprint_options = {
+        'run_mode': run_mode,
+        'image': container_image_path,
+        'njobs': run_njobs,
+        'outputs': run_outputs,
+        'shower_jobs': shower_jobs,
+    }
+
+    fingerprints = {
+        'shared': None,
+        'runs': { name: get_fingerprint(files, fingerprint_options) for name, files in run_files.items() },
+    }
+
+    if args.incremental:
+        old_fingerprints = load_fingerprints(output_dir)
+
+        submit_runs = [ name for name in run_dirs if old_fingerprints['runs'].get(name) != fingerprints['runs'][name] ]
+
+        print(f'- {len(run_dirs)-len(submit_runs)} run dirs unchanged, {len(submit_runs)} to rebuild')
+        for name in submit_runs:
+            print(f'  removing previous inputs and outputs of {name}')
+            if not args.dry_run:
+                remove_run_outputs(output_dir, name)
+
+        for name in old_fingerprints['runs']:
+            if name not in run_dirs:
+                print(f'  {name} is not in the configuration anymore, keeping its files')
+    else:
+        old_fingerprints = None
+        submit_runs = list(run_dirs)
+
 
     # Prepare input files
+    orchestrate = args.orchestrate and not args.dry_run
+    stage_run = None
     if run_mode in ('condor', 'jupiter'):
-        for name, run_dir in run_dirs.items():
-            print(f'- Compressing input files here: {output_dir}/run_{name}.tar.gz')
-            os.system(f'tar -czf {output_dir}/run_{name}.tar.gz -C {run_dir} .')
-            os.system(f'rm -rf {run_dir}')
+        # files common to all run dirs go once in a shared tarball, transferred with each job
+        shared_input_file = f'inputs_{run_name}.tar.gz'
+        common_files, run_files = split_common_files(run_files)
+
+        fingerprints['shared'] = get_fingerprint(common_files, fingerprint_options)
+
+        # if the shared inputs changed all run tarballs are rebuilt, but only the changed ones are submitted
+        if old_fingerprints is not None and old_fingerprints['shared'] == fingerprints['shared']:
+            stage_runs = submit_runs
+            common_path = None
+        else:
+            stage_runs = list(run_dirs)
+            common_path = f'{output_dir}/{shared_input_file}'
+            print(f'- Compressing shared input files here: {common_path} ({", ".join(common_files)})')
+
+        # when orchestrating, the run tarballs are packed right before each submission
+        if orchestrate:
+            stage_run = lambda name: write_run_tarball(f'{run_dirs[name]}.tar.gz', run_files[name])
+            stage_runs = [ name for name in stage_runs if name not in submit_runs ]
+
+        print(f'- Compressing run input files here: {output_dir}/run_<name>.tar.gz')
+        stage_run_dirs({ name: run_dirs[name] for name in stage_runs }, run_files, compress=True, workers=args.workers,
+                       common_path=common_path, common_files=common_files)
     else:
         print('- Running locally, no need to compress input files')
+        stage_run_dirs({ name: run_dirs[name] for name in submit_runs }, run_files, compress=False, workers=args.workers)
 
 
     # # Configuration for each run dir
@@ -639,7 +2592,8 @@ def main():
             f.write(template_run_condor_script)
         os.chmod(script_path, 0o755)
     elif run_mode in ('local-docker', 'local-apptainer'):
-        for name, run_dir in run_dirs.items():
+        for name in submit_runs:
+            run_dir = run_dirs[name]
             script_path = f'{run_dir}/run_mg_pythia_delphes.sh'
             print(f'- Preparing run script: {script_path}')
             with open(script_path, 'w') as f:
@@ -650,22 +2604,32 @@ def main():
     #-----------
     # Local run
     #-----------
-    if run_mode in ('local-docker', 'local-apptainer'):
+    if not submit_runs:
+        print('- Nothing to run, all run dirs are unchanged')
+        if not args.dry_run:
+            save_fingerprints(output_dir, fingerprints)
 
-        for run_name, run_dir in run_dirs.items():
+    elif run_mode in ('local-docker', 'local-apptainer'):
 
-            cmd = f'source /setup_mg_pythia_delphes.sh ; '
-            cmd += f'cd /local ; '
-            cmd += f'./run_mg_pythia_delphes.sh {run_name} run_{run_name}'
+        seeds_info = load_seeds(output_dir, get_seed_base(config))
+        run_seeds = { name: allocate_seeds(seeds_info, 1) for name in submit_runs }
+        if not args.dry_run:
+            save_seeds(output_dir, seeds_info)
 
-            if run_mode == 'local-docker':
-                cmd = f'docker run --rm -v {run_dir}:/local {container_image_path} "{cmd}"'
-            elif run_mode == 'local-apptainer':
-                cmd = f'apptainer exec --bind {run_dir}:/local {container_image_path} /bin/bash -l -c "{cmd}"'
+        if orchestrate:
+            if args.fake_scheduler:
+                executor = FakeExecutor(output_dir)
+            else:
+                executor = LocalExecutor(run_mode, container_image_path, output_dir, run_dirs)
+            failed = asyncio.run(orchestrate_runs(executor, output_dir, submit_runs, run_seeds))
+            save_fingerprints(output_dir, fingerprints, failed)
+            if failed:
+                sys.exit(1)
+            return
 
-            print(cmd)
-            if not args.dry_run:
-                os.system(cmd)
+        failed = run_local(run_mode, container_image_path, output_dir, { name: run_dirs[name] for name in submit_runs }, run_seeds, args.dry_run)
+        if not args.dry_run:
+            save_fingerprints(output_dir, fingerprints, failed)
 
     elif run_mode in ('condor', 'jupiter'):
 
@@ -681,28 +2645,78 @@ def main():
         else:
             job_replace_dict['requirements'] = ''
 
-        job_replace_dict['input_file'] = 'run_$(run_name).tar.gz'
-        job_replace_dict['arguments']  = '$(run_name) $(input_file) $(outputs) $(output_name)'
+        # number of jobs/events of each run, used by the status command
+        runs_info = load_runs_info(output_dir) if args.incremental else {}
+        for name in submit_runs:
+            runs_info[name] = { 'nevents': run_nevents, 'njobs': run_njobs, 'outputs': run_outputs }
+            # the events are counted in the generation jobs
+            if shower_jobs:
+                runs_info[f'shower_{name}'] = { 'nevents': 0, 'njobs': run_njobs * shower_jobs, 'outputs': run_outputs, 'shower': True }
+        if not args.dry_run:
+            save_runs_info(output_dir, runs_info)
 
-        jobs = ''
-        for name in run_dirs.keys():
+        # a different seed for each job
+        seeds_info = load_seeds(output_dir, get_seed_base(config))
+        run_seeds = { name: allocate_seeds(seeds_info, run_njobs) for name in submit_runs }
 
-            if 'hepmc0' in run_outputs and run_njobs > 1:
-                outputs_str = ','.join([ o for o in run_outputs if o != 'hepmc0' ])
+        # cpus/memory
+        request_cpus, request_memory = get_job_resources(config, output_dir)
+        job_replace_dict['resources'] = f'request_cpus = {request_cpus}\nrequest_memory = {request_memory}'
 
-                jobs += f'run_name = {name}\n'
-                jobs += f'outputs = {outputs_str},hepmc\n'
-                jobs += f'queue\n'
+        # parallel_shower: a chunk of events for each cpu, each one with the seed of the job + i
+        job_replace_dict['environment'] = ''
+        if parallel_shower:
+            nchunks = min(request_cpus, seed_stride)
+            if nchunks < request_cpus:
+                print(f'Warning: expert.parallel_shower uses {nchunks} chunks (seeds of different jobs are {seed_stride} apart)')
+            job_replace_dict['environment'] = f'environment = "PARALLEL_SHOWER_CHUNKS={nchunks}"'
 
-                jobs += f'run_name = {name}\n'
-                jobs += f'outputs = {outputs_str}\n'
-                jobs += f'queue {run_njobs-1}\n'
+        job_replace_dict['shared_input_file'] = shared_input_file
+        job_replace_dict['input_file'] = 'run_$(run_name).tar.gz'
+        job_replace_dict['arguments']  = '$(run_name) $(input_file) $(outputs) $(output_name) $(shared_input_file) $(seed)'
 
+        if orchestrate:
+            if args.fake_scheduler:
+                executor = FakeExecutor(output_dir)
             else:
-                jobs += f'run_name = {name}\n'
-                jobs += f'outputs = {",".join(run_outputs)}\n'
-                jobs += f'queue {run_njobs}\n'
+                executor = CondorExecutor(output_dir, job_replace_dict, run_outputs, seeds_info,
+                                          timeout=args.timeout * 3600 if args.timeout else None)
+            failed = asyncio.run(orchestrate_runs(executor, output_dir, submit_runs, run_seeds, stage_run))
+            save_seeds(output_dir, seeds_info)
+            save_fingerprints(output_dir, fingerprints, failed)
+            if failed:
+                sys.exit(1)
+            return
+
+        if args.dag:
+            shower = None
+            if shower_jobs:
+                shower = {
+                    'jobs': shower_jobs,
+                    'seeds': { name: allocate_seeds(seeds_info, run_njobs * shower_jobs) for name in submit_runs },
+                    'resources': f'request_cpus = 1\nrequest_memory = {request_memory}',
+                }
 
+            dag_file = write_dag(output_dir, run_name, submit_runs, job_replace_dict, run_outputs, run_seeds, config.get('dag'), shower)
+
+            print(f'- Saving DAG description in {output_dir}/{dag_file}')
+            if not args.dry_run:
+                os.chdir(output_dir)
+                sc = os.system(f'condor_submit_dag {dag_file}')
+                save_fingerprints(output_dir, fingerprints, submit_runs if sc != 0 else ())
+                node_seeds = { f'gen_{name}': run_seeds[name] for name in submit_runs }
+                if shower is not None:
+                    node_seeds.update({ f'shower_{name}': seeds for name, seeds in shower['seeds'].items() })
+                if sc == 0:
+                    record_dag_seeds(seeds_info, dag_file, node_seeds)
+                    save_seeds(output_dir, seeds_info)
+            return
+
+        jobs = ''
+        submitted = []
+        for name in submit_runs:
+            jobs += get_jobs_queue(name, run_outputs, run_seeds[name])
+            submitted += [ (name, seed) for seed in run_seeds[name] ]
 
         job_replace_dict['jobs'] = jobs
 
@@ -719,7 +2733,11 @@ def main():
         if not args.dry_run:
             # not using htcondor python api because it does nto support multiple queue in the same job?
             os.chdir(output_dir)
-            os.system(f'condor_submit {job_file}')
+            cluster = condor_submit(job_file)
+            if cluster is not None:
+                record_job_seeds(seeds_info, cluster, submitted)
+            save_seeds(output_dir, seeds_info)
+            save_fingerprints(output_dir, fingerprints, submit_runs if cluster is None else ())
 
 
 